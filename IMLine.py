@@ -1,157 +1,379 @@
 # IMLine.py
-from flask import Flask, request, send_from_directory, jsonify
+from flask import request
+from flask_common import create_app, json_response, publish_openapi_spec, send_static
 from flask_swagger_ui import get_swaggerui_blueprint
 import requests
-import json
 import config
 import logging
 import IoTQbroker
 import IMQbroker
+from shared_state import IdSet
+from im_transport import http_session, send_telegram_batch, group_recipients_by_platform
 import threading
 from threading import Lock
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import os
+import queue
+from collections import defaultdict
+from cachetools import TTLCache
 from linebot import LineBotApi
 from linebot.exceptions import LineBotApiError
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = create_app(__name__)
+
+# Shared pool for broadcast fan-out; sends are I/O-bound, so recipients are contacted concurrently
+broadcast_pool = ThreadPoolExecutor(max_workers=32)
+
+# Webhook events are queued and processed by background workers so LINE gets its 200 immediately.
+# Each worker has its own queue and a chat's events always go to the same one, so they run in order.
+WEBHOOK_WORKER_COUNT = 8
+webhook_queues = [queue.Queue(maxsize=10000 // WEBHOOK_WORKER_COUNT) for _ in range(WEBHOOK_WORKER_COUNT)]
+
+def webhook_queue_for(chat_id: str) -> queue.Queue:
+    return webhook_queues[hash(chat_id) % WEBHOOK_WORKER_COUNT]
+
+# Constant responses for the hot routes
+WEBHOOK_OK_RESPONSE = json_response({"ok": True})
+WEBHOOK_IGNORED_RESPONSE = json_response({"ok": True, "message": "No events in request, ignored"})
+MESSAGE_SENT_RESPONSE = json_response({"ok": True, "message": "Message sent"})
+MESSAGE_FAILED_RESPONSE = json_response({"ok": False, "message": "Failed to send message"}, 500)
+
+# LINE endpoint and auth headers are fixed for the process, so build them once instead of per call
+LINE_PUSH_URL = f"{config.LINE_API_URL}/push"
+LINE_MULTICAST_URL = f"{config.LINE_API_URL}/multicast"
+LINE_GROUP_SUMMARY_URL = f"{config.LINE_API_URL}/group/{{group_id}}/summary"
+# Most user ids LINE accepts in one multicast request
+LINE_MULTICAST_LIMIT = 500
+LINE_HEADERS = {"Authorization": f"Bearer {config.LINE_ACCESS_TOKEN}", "Content-Type": "application/json"}
 
 try:
     line_bot_api = LineBotApi(config.LINE_ACCESS_TOKEN)
     logger.info("LineBotApi initialized successfully")
 except Exception as e:
-    logger.error(f"Failed to initialize LineBotApi: {e}")
+    logger.error("Failed to initialize LineBotApi: %s", e)
     raise
 
-user_ids = set()
-user_ids_lock = Lock()
+# Shared through Redis when REDIS_URL is set so several workers agree on who was greeted
+user_ids = IdSet("imline:user_ids")
+greeted_users = IdSet("imline:greeted_users")
 
-greeted_users = set()
-greeted_users_lock = Lock()
+# Display/group names rarely change, so cache them to skip the LINE profile/summary call on repeat messages.
+# Failed lookups are cached briefly so a 4xx from LINE is not retried on every message.
+name_cache = TTLCache(maxsize=10000, ttl=3600)
+failed_name_cache = TTLCache(maxsize=10000, ttl=60)
+name_cache_lock = Lock()
+# Name lookups currently being fetched, keyed like name_cache, so concurrent misses share one call
+inflight_names = {}
+inflight_names_lock = Lock()
 
 def add_user_id(user_id: str):
-    with user_ids_lock:
-        user_ids.add(user_id)
-        logger.debug(f"Added user_id={user_id} to user_ids set")
+    if user_ids.add(user_id):
+        logger.debug("Added user_id=%s to user_ids set", user_id)
 
 def check_and_add_greeted_user(chat_id: str) -> bool:
-    with greeted_users_lock:
-        if chat_id not in greeted_users:
-            greeted_users.add(chat_id)
-            return True
-        return False
+    return greeted_users.add(chat_id)
+
+def get_cached_name(key: str):
+    with name_cache_lock:
+        name = name_cache.get(key)
+        if name is None:
+            name = failed_name_cache.get(key)
+        return name
+
+def cache_name(key: str, name: str, failed: bool = False):
+    with name_cache_lock:
+        if failed:
+            failed_name_cache[key] = name
+        else:
+            name_cache[key] = name
+
+def lookup_name(key: str, fetch, default: str) -> str:
+    """Return the cached name for key, or fetch it once even if several threads miss at the same time.
+
+    The first thread to miss owns the fetch; concurrent callers wait on its Future instead of
+    issuing their own LINE API call, and fall back to default if it takes too long.
+    """
+    cached_name = get_cached_name(key)
+    if cached_name is not None:
+        return cached_name
+    with inflight_names_lock:
+        future = inflight_names.get(key)
+        owner = future is None
+        if owner:
+            future = inflight_names[key] = Future()
+    if not owner:
+        try:
+            return future.result(timeout=5)
+        except Exception:
+            return default
+    try:
+        name = fetch(key)
+        future.set_result(name)
+        return name
+    except Exception as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with inflight_names_lock:
+            inflight_names.pop(key, None)
 
 def get_line_user_display_name(user_id: str) -> str:
+    return lookup_name(user_id, fetch_line_user_display_name, "User")
+
+def get_line_group_name(group_id: str) -> str:
+    return lookup_name(group_id, fetch_line_group_name, "Group")
+
+def fetch_line_user_display_name(user_id: str) -> str:
     try:
         profile = line_bot_api.get_profile(user_id)
         display_name = profile.display_name or "User"
-        logger.debug(f"Fetched display name for user_id={user_id}: {display_name}")
+        logger.debug("Fetched display name for user_id=%s: %s", user_id, display_name)
+        cache_name(user_id, display_name)
         return display_name
     except LineBotApiError as e:
-        logger.warning(f"LineBotApiError fetching display name for user_id={user_id}: {e}")
+        logger.warning("LineBotApiError fetching display name for user_id=%s: %s", user_id, e)
+        cache_name(user_id, "User", failed=True)
         return "User"
     except Exception as e:
-        logger.error(f"Unexpected error fetching display name for user_id={user_id}: {e}")
+        logger.error("Unexpected error fetching display name for user_id=%s: %s", user_id, e)
+        cache_name(user_id, "User", failed=True)
         return "User"
 
-def get_line_group_name(group_id: str) -> str:
-    url = f"{config.LINE_API_URL}/group/{group_id}/summary"
-    headers = {"Authorization": f"Bearer {config.LINE_ACCESS_TOKEN}", "Content-Type": "application/json"}
+def fetch_line_group_name(group_id: str) -> str:
     try:
-        response = requests.get(url, headers=headers, timeout=5)
+        response = http_session.get(LINE_GROUP_SUMMARY_URL.format(group_id=group_id), headers=LINE_HEADERS, timeout=5)
         response.raise_for_status()
         group_summary = response.json()
-        return group_summary.get("groupName", "Group")
+        group_name = group_summary.get("groupName", "Group")
+        cache_name(group_id, group_name)
+        return group_name
     except requests.exceptions.RequestException as e:
-        logger.warning(f"Failed to fetch group name for group_id={group_id}: {e}")
+        logger.warning("Failed to fetch group name for group_id=%s: %s", group_id, e)
+        cache_name(group_id, "Group", failed=True)
         return "Group"
 
 def send_message(to: str, text: str, display_name: str = None) -> bool:
+    greeting = f"Hi, {display_name or 'User'}\n" if check_and_add_greeted_user(to) else ""
+    return push_message(to, f"{greeting}{text}")
+
+def push_message(to: str, message_text: str) -> bool:
+    """Push message_text as-is to one user, group or room."""
     if not config.LINE_ACCESS_TOKEN:
         logger.error("LINE_ACCESS_TOKEN is not set")
         return False
-    url = f"{config.LINE_API_URL}/push"
-    headers = {"Authorization": f"Bearer {config.LINE_ACCESS_TOKEN}", "Content-Type": "application/json"}
-    greeting = f"Hi, {display_name or 'User'}\n" if check_and_add_greeted_user(to) else ""
-    message_text = f"{greeting}{text}"
     payload = {"to": to, "messages": [{"type": "text", "text": message_text}]}
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=5)
+        response = http_session.post(LINE_PUSH_URL, headers=LINE_HEADERS, json=payload, timeout=5)
         response.raise_for_status()
-        logger.info(f"Message sent successfully: to={to}, display_name={display_name}, text={message_text}")
+        logger.info("Message sent successfully: to=%s, text=%s", to, message_text)
         return True
     except requests.exceptions.RequestException as e:
-        logger.error(f"Error sending message to {to}: {e}, Response: {response.text if 'response' in locals() else 'No response'}")
+        logger.error("Error sending message to %s: %s, Response: %s", to, e, response.text if 'response' in locals() else 'No response')
+        return False
+
+def multicast_message(to: list, message_text: str) -> bool:
+    """Send message_text to up to LINE_MULTICAST_LIMIT user ids in one request.
+
+    If LINE rejects the request itself (a 4xx other than rate limiting, e.g. one bad id),
+    the chunk falls back to one push per user so the valid recipients still get it.
+    """
+    if not config.LINE_ACCESS_TOKEN:
+        logger.error("LINE_ACCESS_TOKEN is not set")
+        return False
+    payload = {"to": to, "messages": [{"type": "text", "text": message_text}]}
+    try:
+        response = http_session.post(LINE_MULTICAST_URL, headers=LINE_HEADERS, json=payload, timeout=5)
+    except requests.exceptions.RequestException as e:
+        logger.error("Error multicasting to %s users: %s", len(to), e)
         return False
+    if response.ok:
+        logger.info("Multicast sent successfully to %s users", len(to))
+        return True
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        logger.warning("Multicast to %s users rejected (%s: %s), pushing individually", len(to), response.status_code, response.text)
+        return all([push_message(user_id, message_text) for user_id in to])
+    logger.error("Multicast to %s users failed: %s - %s", len(to), response.status_code, response.text)
+    return False
+
+def submit_line_multicast(chat_ids, text: str, display_name: str = None) -> list:
+    """Submit multicasts of text to LINE user ids on broadcast_pool and return their futures.
+
+    Users not greeted yet get the greeting prefix, so recipients are split into two
+    messages, each sent in chunks of LINE_MULTICAST_LIMIT.
+    """
+    greeted, fresh = [], []
+    for chat_id in chat_ids:
+        (fresh if check_and_add_greeted_user(chat_id) else greeted).append(chat_id)
+    futures = []
+    for recipients, message_text in ((fresh, f"Hi, {display_name or 'User'}\n{text}"), (greeted, text)):
+        for start in range(0, len(recipients), LINE_MULTICAST_LIMIT):
+            futures.append(broadcast_pool.submit(multicast_message, recipients[start:start + LINE_MULTICAST_LIMIT], message_text))
+    return futures
 
 def send_all_message(text: str, display_name: str = None) -> bool:
-    success = True
-    with user_ids_lock:
-        for uid in list(user_ids):
-            if not send_message(uid, text, display_name):
-                success = False
-                logger.warning(f"Failed to send message to user_id={uid}")
-    return success
+    # One multicast per 500 users instead of one push per user
+    futures = submit_line_multicast(user_ids.members(), text, display_name)
+    return all([future.result() for future in as_completed(futures)])
+
+def send_line_broadcast_message(chat_id: str, message: str) -> bool:
+    if not send_message(chat_id, message):
+        logger.warning("Failed to send message to chat_id=%s on Line", chat_id)
+        return False
+    return True
+
+def bulk_send(platform: str, chat_ids: list, message: str) -> list:
+    """Submit the sends for one platform to broadcast_pool and return their futures.
+
+    LINE users are reached by multicast; LINE groups and rooms (which multicast does not accept)
+    get one push each. Telegram recipients are forwarded in /SendBatch requests of up to
+    config.TELEGRAM_BATCH_SIZE chats.
+    """
+    if platform == "line":
+        # LINE user ids start with "U"; group and room ids start with "C" and "R"
+        futures = submit_line_multicast([chat_id for chat_id in chat_ids if chat_id.startswith("U")], message)
+        futures.extend(broadcast_pool.submit(send_line_broadcast_message, chat_id, message)
+                       for chat_id in chat_ids if not chat_id.startswith("U"))
+        return futures
+    return [broadcast_pool.submit(send_telegram_batch, chat_ids[start:start + config.TELEGRAM_BATCH_SIZE], message)
+            for start in range(0, len(chat_ids), config.TELEGRAM_BATCH_SIZE)]
+
+def broadcast_message(recipients, message: str) -> bool:
+    """Send message to every (chat_id, platform) recipient once; True only if all sends succeed."""
+    futures = []
+    for platform, chat_ids in group_recipients_by_platform(recipients).items():
+        futures.extend(bulk_send(platform, list(chat_ids), message))
+    return all([future.result() for future in as_completed(futures)])
+
+# Source handlers return (display_name, user_id) for an event, or None when the source id is missing
+def handle_user_source(event: dict):
+    user_id = event["user_id"]
+    if not user_id:
+        return None
+    add_user_id(user_id)
+    return get_line_user_display_name(user_id), user_id
+
+def handle_group_source(event: dict):
+    group_id = event["group_id"]
+    return (get_line_group_name(group_id), None) if group_id else None
+
+def handle_room_source(event: dict):
+    return ("Room", None) if event["room_id"] else None
+
+SOURCE_HANDLERS = {
+    'user': handle_user_source,
+    'group': handle_group_source,
+    'room': handle_room_source,
+}
+
+def process_webhook_event(event: dict):
+    chat_id = event["chat_id"]
+    source_type = event["source_type"]
+    message_text = event["message_text"]
+    handler = SOURCE_HANDLERS.get(source_type)
+    source = handler(event) if handler else None
+    if source is None:
+        logger.warning("Unknown source type: %s, skipping", source_type)
+        return
+    display_name, user_id = source
+    logger.info("Received message: chat_id=%s, source_type=%s, display_name=%s, text=%s", chat_id, source_type, display_name, message_text)
+    try:
+        device = IoTQbroker.get_device("LivingRoomLight", config.DEVICE_ID, "line", chat_id)
+        iot_result = IoTQbroker.IoTParse_Message(message_text, device, chat_id, "line", user_id=user_id, username=display_name)
+        logger.debug("IoTParse_Message result: %s", iot_result)
+        if not iot_result.get("success"):
+            send_message(chat_id, iot_result.get("message", "Failed to process command"), display_name)
+    except Exception as e:
+        logger.error("Error processing IoT message for chat_id=%s: %s", chat_id, e, exc_info=True)
+        send_message(chat_id, "An error occurred while processing your command. Please try again.", display_name)
+
+def webhook_worker(work_queue: queue.Queue):
+    while True:
+        event = work_queue.get()
+        try:
+            process_webhook_event(event)
+        except Exception as e:
+            logger.error("Unexpected error processing webhook event: %s", e, exc_info=True)
+        finally:
+            work_queue.task_done()
+
+def start_webhook_workers():
+    for i, work_queue in enumerate(webhook_queues):
+        worker_thread = threading.Thread(target=webhook_worker, args=(work_queue,), name=f"webhook-worker-{i}")
+        worker_thread.daemon = True
+        worker_thread.start()
+    logger.info("Started %s webhook worker threads", WEBHOOK_WORKER_COUNT)
 
 @app.route('/IMLine/webhook', methods=['POST'])
 def webhook():
     try:
-        data = request.get_json()
+        try:
+            data = json_loads(request.get_data())
+        except ValueError:
+            data = None
         if data is None:
             logger.error("Webhook request could not be parsed as JSON")
             return {"ok": False, "message": "Invalid JSON"}, 400
         if 'events' not in data:
             logger.warning("No events in webhook request, ignoring")
-            return {"ok": True, "message": "No events in request, ignored"}, 200
+            return WEBHOOK_IGNORED_RESPONSE
+        # (worker queue, event) in delivery order
+        events = []
         for event in data['events']:
-            event_type = event.get('type')
+            event_get = event.get
+            event_type = event_get('type')
             if event_type != 'message':
-                logger.info(f"Ignoring non-message event: type={event_type}")
+                logger.info("Ignoring non-message event: type=%s", event_type)
                 continue
-            message = event.get('message', {})
+            message = event_get('message', {})
             if message.get('type') != 'text':
-                logger.info(f"Ignoring non-text message: type={message.get('type')}")
+                logger.info("Ignoring non-text message: type=%s", message.get('type'))
                 continue
             message_text = message.get('text', '').strip()
             if not message_text:
                 logger.warning("Empty message text, ignoring")
                 continue
-            source = event.get('source', {})
-            source_type = source.get('type')
-            user_id = source.get('userId')
-            group_id = source.get('groupId')
-            room_id = source.get('roomId')
+            source_get = event_get('source', {}).get
+            source_type = source_get('type')
+            user_id = source_get('userId')
+            group_id = source_get('groupId')
+            room_id = source_get('roomId')
             chat_id = group_id or room_id or user_id
             if not chat_id:
                 logger.error("No userId, groupId, or roomId in webhook request")
                 continue
-            display_name = None
-            if source_type == 'user' and user_id:
-                display_name = get_line_user_display_name(user_id)
-                add_user_id(user_id)
-            elif source_type == 'group' and group_id:
-                display_name = get_line_group_name(group_id)
-            elif source_type == 'room' and room_id:
-                display_name = "Room"
-            else:
-                logger.warning(f"Unknown source type: {source_type}, skipping")
-                continue
-            logger.info(f"Received message: chat_id={chat_id}, source_type={source_type}, display_name={display_name}, text={message_text}")
+            events.append((webhook_queue_for(chat_id), {
+                "chat_id": chat_id,
+                "source_type": source_type,
+                "user_id": user_id,
+                "group_id": group_id,
+                "room_id": room_id,
+                "message_text": message_text
+            }))
+        # Reject the whole request while nothing is enqueued yet, so LINE's redelivery cannot repeat events
+        needed = defaultdict(int)
+        for work_queue, event in events:
+            needed[work_queue] += 1
+        if any(work_queue.maxsize - work_queue.qsize() < count for work_queue, count in needed.items()):
+            logger.error("Webhook queues cannot hold %s events, rejecting request", len(events))
+            return {"ok": False, "message": "Server busy, please retry"}, 503
+        for work_queue, event in events:
             try:
-                device = IoTQbroker.Device("LivingRoomLight", device_id=config.DEVICE_ID, platform="line", chat_id=chat_id)
-                iot_result = IoTQbroker.IoTParse_Message(message_text, device, chat_id, "line", user_id=user_id if source_type == 'user' else None, username=display_name)
-                logger.debug(f"IoTParse_Message result: {iot_result}")
-                if not iot_result.get("success"):
-                    send_message(chat_id, iot_result.get("message", "Failed to process command"), display_name)
-            except Exception as e:
-                logger.error(f"Error processing IoT message for chat_id={chat_id}: {e}", exc_info=True)
-                send_message(chat_id, "An error occurred while processing your command. Please try again.", display_name)
-                continue
-        return {"ok": True}, 200
+                work_queue.put_nowait(event)
+            except queue.Full:
+                # Another request took the space after the check; part of this batch is already
+                # accepted, so drop the rest rather than have LINE redeliver the accepted ones
+                logger.error("Webhook queue is full, dropping event for chat_id=%s", event["chat_id"])
+        return WEBHOOK_OK_RESPONSE
     except Exception as e:
-        logger.error(f"Unexpected error in webhook: {e}", exc_info=True)
+        logger.error("Unexpected error in webhook: %s", e, exc_info=True)
         return {"ok": False, "message": "Internal server error"}, 500
 
 @app.route('/IMLine/SendMsg', methods=['GET'])
@@ -162,7 +384,7 @@ def send_message_route():
         return {"ok": False, "message": "Missing user_id or message"}, 400
     display_name = get_line_user_display_name(user_id)
     success = send_message(user_id, message, display_name)
-    return {"ok": success, "message": "Message sent" if success else "Failed to send message"}, 200 if success else 500
+    return MESSAGE_SENT_RESPONSE if success else MESSAGE_FAILED_RESPONSE
 
 @app.route('/IMLine/SendGroupMessage', methods=['GET'])
 def send_group_message_route():
@@ -174,32 +396,10 @@ def send_group_message_route():
     bindings = config.load_bindings()
     bound_users = bindings.get(device_id, [])
     if not bound_users:
-        logger.warning(f"No bound users for device {device_id}")
+        logger.warning("No bound users for device %s", device_id)
         return {"ok": False, "message": "This device has no bound users"}, 404
 
-    success = True
-    for binding in bound_users:
-        chat_id = binding["chat_id"]
-        platform = binding["platform"]
-        if platform == "line":
-            if not send_message(chat_id, message):
-                success = False
-                logger.warning(f"Failed to send message to chat_id={chat_id} on Line")
-        else:  # platform == "telegram"
-            telegram_url = f"http://{config.TELEGRAM_API_HOST}:{config.TELEGRAM_API_PORT}/SendMsg"
-            params = {
-                "chat_id": chat_id,
-                "message": message,
-                "bot_token": config.TELEGRAM_BOT_TOKEN
-            }
-            try:
-                response = requests.get(telegram_url, params=params, timeout=5)
-                if response.status_code != 200 or not response.json().get("ok"):
-                    success = False
-                    logger.warning(f"Failed to send message to chat_id={chat_id} on Telegram")
-            except requests.RequestException as e:
-                success = False
-                logger.error(f"Error sending message to chat_id={chat_id} on Telegram: {e}")
+    success = broadcast_message([(binding["chat_id"], binding["platform"]) for binding in bound_users], message)
 
     return {"ok": success, "message": "Group message sent" if success else "Some messages failed to send"}, 200 if success else 500
 
@@ -209,76 +409,56 @@ def send_all_message_route():
     if not message:
         return {"ok": False, "message": "Missing message"}, 400
 
-    all_bound_users = set()
-    bindings = config.load_bindings()
-    for device_id in bindings:
-        for binding in bindings[device_id]:
-            all_bound_users.add((binding["chat_id"], binding["platform"]))
+    all_bound_users = config.load_all_bound_users()
 
     if not all_bound_users:
         return {"ok": False, "message": "No users have bound any device"}, 404
 
-    success = True
-    for chat_id, platform in all_bound_users:
-        if platform == "line":
-            if not send_message(chat_id, message):
-                success = False
-                logger.warning(f"Failed to send message to chat_id={chat_id} on Line")
-        else:  # platform == "telegram"
-            telegram_url = f"http://{config.TELEGRAM_API_HOST}:{config.TELEGRAM_API_PORT}/SendMsg"
-            params = {
-                "chat_id": chat_id,
-                "message": message,
-                "bot_token": config.TELEGRAM_BOT_TOKEN
-            }
-            try:
-                response = requests.get(telegram_url, params=params, timeout=5)
-                if response.status_code != 200 or not response.json().get("ok"):
-                    success = False
-                    logger.warning(f"Failed to send message to chat_id={chat_id} on Telegram")
-            except requests.RequestException as e:
-                success = False
-                logger.error(f"Error sending message to chat_id={chat_id} on Telegram: {e}")
+    success = broadcast_message(all_bound_users, message)
 
     return {"ok": success, "message": "All messages sent" if success else "Some messages failed to send"}, 200 if success else 500
 
 SWAGGER_URL = '/IMLine/swagger'
 API_URL = '/IMLine/static/openapi.yaml'
+# Browsers may reuse the Swagger spec for a day; ETag/Last-Modified handle revalidation
+STATIC_MAX_AGE = 86400
 swaggerui_blueprint = get_swaggerui_blueprint(SWAGGER_URL, API_URL, config={'app_name': "IM and IoT Microservices"})
 app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
 
 @app.route('/IMLine/static/<path:path>')
 def send_swagger(path):
     try:
-        return send_from_directory('static', path)
+        return send_static(path, STATIC_MAX_AGE)
     except Exception as e:
-        logger.error(f"Failed to serve static file {path}: {e}")
+        logger.error("Failed to serve static file %s: %s", path, e)
         return {"ok": False, "message": "File not found"}, 404
 
-if __name__ == "__main__":
+def init_service():
+    """Prepare the Swagger static files and start the webhook workers and LINE queue consumer for this process."""
     try:
-        if not os.path.exists('static'):
-            os.makedirs('static')
-            logger.info("Created static directory")
         if os.path.exists('openapi.yaml'):
-            with open('static/openapi.yaml', 'w') as f:
-                with open('openapi.yaml', 'r') as src:
-                    f.write(src.read())
+            publish_openapi_spec()
             logger.info("Successfully copied openapi.yaml to static directory")
         else:
             logger.warning("openapi.yaml file not found, Swagger UI may not work")
     except Exception as e:
-        logger.error(f"Error setting up static directory or openapi.yaml: {e}")
+        logger.error("Error setting up static directory or openapi.yaml: %s", e)
+    start_webhook_workers()
     try:
         imqbroker_thread = threading.Thread(target=IMQbroker.consume_line_queue)
         imqbroker_thread.daemon = True
         imqbroker_thread.start()
         logger.info("IMQbroker started for LINE queue")
     except Exception as e:
-        logger.error(f"Failed to start IMQbroker thread: {e}")
+        logger.error("Failed to start IMQbroker thread: %s", e)
         raise
+
+# Development entry point; in production serve with
+#   gunicorn -c gunicorn.conf.py -b 0.0.0.0:5001 IMLine:app
+if __name__ == "__main__":
+    init_service()
     try:
         app.run(host="0.0.0.0", port=config.LINE_API_PORT, threaded=True, debug=False)
     except Exception as e:
-        logger.error(f"Failed to start Flask service: {e}")
+        logger.error("Failed to start Flask service: %s", e)
         raise
\ No newline at end of file
@@ -1,151 +1,236 @@
 # IMQbroker.py
-import pika
-import json
-import requests
+import broker
+import functools
 import logging
 import config
+import sys
 import time
-from IoTQbroker import Device
+from threading import Lock
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from IoTQbroker import get_device
+from im_transport import send_message, send_many
+from shared_state import IdSet
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-greeted_users = set()
-
-def send_message(chat_id: str, text: str, platform: str = "telegram", user_id: str = None, username: str = None) -> bool:
-    """Send message to the appropriate platform based on the platform parameter"""
-    try:
-        if platform == "telegram":
-            url = f"http://{config.TELEGRAM_API_HOST}:{config.TELEGRAM_API_PORT}/IMTelegram/SendMsg"
-            params = {
-                "chat_id": chat_id,
-                "message": text,
-                "user_id": user_id,
-                "bot_token": config.TELEGRAM_BOT_TOKEN
-            }
-        elif platform == "line":
-            url = f"http://{config.LINE_API_HOST}:{config.LINE_API_PORT}/IMLine/SendMsg"
-            params = {
-                "user_id": chat_id,
-                "message": text,
-                "caller_user_id": username,
-                "bot_token": config.LINE_ACCESS_TOKEN
-            }
-        else:
-            logger.error(f"Unsupported platform: {platform}")
-            return False
-
-        logger.info(f"Sending message to {platform} API: {url}")
-        response = requests.get(url, params=params, timeout=5)
-        
-        if response.status_code == 200 and response.json().get("ok"):
-            logger.info(f"Message sent successfully to {platform}: {text}")
-            return True
-        else:
-            logger.error(f"Failed to send message to {platform}: {response.text}")
-            return False
-    except Exception as e:
-        logger.error(f"Error sending message to {platform}: {e}")
-        return False
+# Each prefetched delivery is handled on handler_pool so the pika I/O thread keeps
+# reading while notifications are in flight.
+handler_pool = ThreadPoolExecutor(max_workers=config.RABBITMQ_PREFETCH)
+# Separate pool for the operator's reply so handlers never wait on their own pool
+send_pool = ThreadPoolExecutor(max_workers=32)
+
+# Platforms a status update may come from
+SUPPORTED_PLATFORMS = frozenset({"telegram", "line"})
+
+# (device_id, platform) -> (bindings dict, members_version, recipients); see get_device_recipients
+recipient_cache = {}
+recipient_cache_lock = Lock()
+
+# Shared through Redis when REDIS_URL is set, like IMLine's greeted users
+greeted_users = IdSet("imqbroker:greeted_users")
+
+def check_and_add_greeted_user(chat_id: str) -> bool:
+    return greeted_users.add(chat_id)
+
+def get_device_recipients(device, platform: str) -> dict:
+    """Return {platform: frozenset(chat_id)} to notify for device: its group members, plus bound users.
+
+    The map is cached per device and platform and rebuilt only when load_bindings_shared() returns a
+    reloaded dict or the device's group membership version changes. Chat ids are interned so a
+    user bound to several devices is stored once across the cached sets.
+    """
+    bindings = config.load_bindings_shared()
+    key = (device.device_id, platform)
+    with recipient_cache_lock:
+        cached = recipient_cache.get(key)
+        # Read the version before the members: a concurrent join then only causes an extra rebuild
+        version = device.members_version
+        if cached and cached[0] is bindings and cached[1] == version:
+            return cached[2]
+        seen = set()
+        by_platform = defaultdict(set)
+        if device.group_id:
+            for member, member_platform in device.group_members:
+                member = sys.intern(member)
+                seen.add(member)
+                by_platform[member_platform].add(member)
+        for binding in bindings.get(device.device_id, []):
+            member = sys.intern(binding["chat_id"])
+            if member not in seen:
+                seen.add(member)
+                by_platform[binding["platform"]].add(member)
+        recipients = {recipient_platform: frozenset(chats) for recipient_platform, chats in by_platform.items()}
+        recipient_cache[key] = (bindings, version, recipients)
+        return recipients
 
 def init_rabbitmq_connection():
-    """Initialize RabbitMQ connection with retry mechanism"""
+    """Initialize RabbitMQ connection, retrying with exponential backoff"""
+    backoff = 1
     while True:
         try:
-            parameters = pika.ConnectionParameters(
-                host=config.RABBITMQ_HOST, 
-                port=config.RABBITMQ_PORT, 
-                heartbeat=30, 
-                blocked_connection_timeout=60
-            )
-            connection = pika.BlockingConnection(parameters)
-            channel = connection.channel()
-            logger.info(f"Initialized RabbitMQ connection: host={config.RABBITMQ_HOST}, port={config.RABBITMQ_PORT}")
+            connection, channel = broker.connect()
+            logger.info("Initialized RabbitMQ connection: host=%s, port=%s", config.RABBITMQ_HOST, config.RABBITMQ_PORT)
             return connection, channel
         except Exception as e:
-            logger.error(f"Failed to initialize RabbitMQ connection: {e}")
-            time.sleep(5)
+            logger.error("Failed to initialize RabbitMQ connection: %s, retrying in %ss", e, backoff)
+            time.sleep(backoff)
+            backoff = min(broker.RECONNECT_MAX_BACKOFF, backoff * 2)
+
+def handle_status_message(message: dict):
+    """Notify the operator, the device's group members and its bound users of a status change."""
+    logger.info("Received status message: %s", message)
+
+    platform = message.get("platform", "unknown")
+    chat_id = message.get("chat_id")
+    device_status = message.get("device_status")
+    device_id = message.get("device_id", config.DEVICE_ID)
+    user_id = message.get("user_id")
+    username = message.get("username", "User")
+
+    if not device_status:
+        logger.warning("Message does not contain device_status: %s", message)
+        return
+
+    if not chat_id:
+        logger.error("No chat_id found in message: %s", message)
+        return
+
+    if platform not in SUPPORTED_PLATFORMS:
+        logger.error("Invalid platform: %s", platform)
+        return
+
+    greeting = f"Hi, {username}\n" if check_and_add_greeted_user(chat_id) else ""
+    formatted_message = f"{greeting}Device {device_id} is now {device_status}, operated by user {username}"
+    other_message = f"Device {device_id} has been set to {device_status} by user {username}"
+
+    device = get_device("LivingRoomLight", device_id)
+
+    # The operator's reply goes out while the rest are sent in one send_many pass per platform
+    operator_future = send_pool.submit(send_message, chat_id, formatted_message, platform, user_id=user_id, username=username)
+    for recipient_platform, chats in get_device_recipients(device, platform).items():
+        # Only copy the cached set when the operator is in it
+        recipients = chats - {chat_id} if chat_id in chats else chats
+        if recipients and not send_many(recipients, other_message, recipient_platform, user_id=user_id, username=username):
+            logger.warning("Some status updates for device %s failed on platform %s", device_id, recipient_platform)
+
+    if not operator_future.result():
+        logger.warning("Failed to send status update to chat_id=%s on platform %s", chat_id, platform)
+
+class BatchAcker:
+    """Acknowledge finished deliveries in batches with multiple=True.
+
+    Handlers finish out of order, so only the contiguous run of settled tags at the head of
+    the delivery order is acked. Failed deliveries are nacked individually straight away.
+    All methods run on the connection's thread.
+    """
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+        self.pending = deque()
+        self.settled = {}
+        self.last_ok_tag = None
+        self.unacked_count = 0
+
+    def track(self, delivery_tag: int):
+        self.pending.append(delivery_tag)
+
+    def settle(self, delivery_tag: int, ok: bool):
+        if not ok:
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=False)
+        self.settled[delivery_tag] = ok
+        while self.pending and self.pending[0] in self.settled:
+            tag = self.pending.popleft()
+            if self.settled.pop(tag):
+                self.last_ok_tag = tag
+                self.unacked_count += 1
+        if self.unacked_count >= config.RABBITMQ_ACK_BATCH_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.last_ok_tag is not None and self.channel.is_open:
+            self.channel.basic_ack(delivery_tag=self.last_ok_tag, multiple=True)
+        self.last_ok_tag = None
+        self.unacked_count = 0
+
+    def flush_periodically(self):
+        # Partial batches are acked at least every RABBITMQ_ACK_FLUSH_INTERVAL seconds
+        self.flush()
+        if self.connection.is_open:
+            self.connection.call_later(config.RABBITMQ_ACK_FLUSH_INTERVAL, self.flush_periodically)
+
+def process_queue_message(connection, acker, delivery_tag, body):
+    """Handle one delivery on handler_pool and hand the ack/nack back to the connection's thread.
+
+    acker is None when the delivery was already acked optimistically (RABBITMQ_WAIT_FOR_SEND off).
+    """
+    ok = False
+    try:
+        handle_status_message(json_loads(body))
+        ok = True
+    except ValueError as e:
+        logger.error("Failed to parse message body as JSON: %s, body=%s", e, body)
+    except Exception as e:
+        logger.error("Error processing message: %s, body=%s", e, body, exc_info=True)
+    if acker is None:
+        return
+    try:
+        # pika channels are not thread-safe; acks must run on the thread driving the connection
+        connection.add_callback_threadsafe(functools.partial(acker.settle, delivery_tag, ok))
+    except Exception as e:
+        logger.warning("Could not settle delivery %s, broker will redeliver it: %s", delivery_tag, e)
 
 def consume_queue(queue_name: str):
-    """Consume messages from RabbitMQ queue"""
-    connection, channel = init_rabbitmq_connection()
-    
-    try:
-        channel.queue_declare(queue=queue_name, durable=True)
-        channel.basic_qos(prefetch_count=1)
+    """Consume messages from RabbitMQ queue, reconnecting in a loop with exponential backoff"""
+    backoff = 1
+    while True:
+        connection, channel = init_rabbitmq_connection()
 
-        def callback(ch, method, properties, body):
-            try:
-                message = json.loads(body)
-                logger.info(f"Received message from queue {queue_name}: {message}")
-
-                platform = message.get("platform", "unknown")
-                chat_id = message.get("chat_id")
-                device_status = message.get("device_status")
-                device_id = message.get("device_id", config.DEVICE_ID)
-                user_id = message.get("user_id")
-                username = message.get("username", "User")
-                bot_token = message.get("bot_token")
-                
-                if not device_status:
-                    logger.warning(f"Message does not contain device_status: {message}")
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    return
-                
-                if not chat_id:
-                    logger.error(f"No chat_id found in message: {message}")
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
+        try:
+            channel.queue_declare(queue=queue_name, durable=True)
+            channel.basic_qos(prefetch_count=config.RABBITMQ_PREFETCH)
+            acker = BatchAcker(connection, channel)
+
+            def callback(ch, method, properties, body):
+                nonlocal backoff
+                backoff = 1
+                acker.track(method.delivery_tag)
+                # Producers tag status updates in a header; anything else is acked without decoding.
+                # Messages without the header (older producers) are decoded as before.
+                event = (properties.headers or {}).get(broker.EVENT_HEADER)
+                if event is not None and event != broker.STATUS_UPDATE:
+                    logger.debug("Skipping %s event on %s", event, queue_name)
+                    acker.settle(method.delivery_tag, True)
                     return
-
-                if platform not in ["telegram", "line"]:
-                    logger.error(f"Invalid platform: {platform}")
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                if not config.RABBITMQ_WAIT_FOR_SEND:
+                    # Ack on hand-off; a crash before the sends finish loses this update
+                    acker.settle(method.delivery_tag, True)
+                    handler_pool.submit(process_queue_message, connection, None, method.delivery_tag, body)
                     return
+                handler_pool.submit(process_queue_message, connection, acker, method.delivery_tag, body)
 
-                greeting = f"Hi, {username}\n" if chat_id not in greeted_users else ""
-                if greeting:
-                    greeted_users.add(chat_id)
-                formatted_message = f"{greeting}Device {device_id} is now {device_status}, operated by user {username}"
-                
-                success = send_message(chat_id, formatted_message, platform, user_id=user_id, username=username)
-                if not success:
-                    logger.warning(f"Failed to send status update to chat_id={chat_id} on platform {platform}")
-
-                notified_users = {chat_id}
-                device = Device("LivingRoomLight", device_id=device_id)
-                
-                if device.group_id and device.group_members:
-                    notified_users.update(device.group_members)
-                    for member in device.group_members:
-                        if member != chat_id:
-                            other_message = f"Device {device_id} has been set to {device_status} by user {username}"
-                            send_message(member, other_message, platform, user_id=user_id, username=username)
-
-                bound_users = device.get_bound_users()
-                for bound_chat_id, bound_platform in bound_users:
-                    if bound_chat_id not in notified_users:
-                        other_message = f"Device {device_id} has been set to {device_status} by user {username}"
-                        send_message(bound_chat_id, other_message, bound_platform, user_id=user_id, username=username)
-                        notified_users.add(bound_chat_id)
-
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-            except json.JSONDecodeError as e:
-                logger.error(f"Failed to parse message body as JSON: {e}, body={body}")
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=False)
+            connection.call_later(config.RABBITMQ_ACK_FLUSH_INTERVAL, acker.flush_periodically)
+            logger.info("Started consuming %s with prefetch_count=%s...", queue_name, config.RABBITMQ_PREFETCH)
+            channel.start_consuming()
+            return
+        except Exception as e:
+            logger.error("Error consuming queue %s: %s, restarting in %ss", queue_name, e, backoff)
+        finally:
+            # Release the socket and pika's I/O loop before reconnecting or returning
+            try:
+                if not connection.is_closed:
+                    connection.close()
             except Exception as e:
-                logger.error(f"Error processing message: {e}, body={body}", exc_info=True)
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-
-        channel.basic_consume(queue=queue_name, on_message_callback=callback, auto_ack=False)
-        logger.info(f"Started consuming {queue_name}...")
-        channel.start_consuming()
-    except Exception as e:
-        logger.error(f"Error consuming queue {queue_name}: {e}")
-        if connection and not connection.is_closed:
-            connection.close()
-        time.sleep(5)
-        # Restart consuming
-        consume_queue(queue_name)
+                logger.debug("Error closing RabbitMQ connection for %s: %s", queue_name, e)
+        time.sleep(backoff)
+        backoff = min(broker.RECONNECT_MAX_BACKOFF, backoff * 2)
 
 def consume_line_queue():
     consume_queue(config.RABBITMQ_LINE_QUEUE)
@@ -1,65 +1,102 @@
 # IMTelegram.py
-from flask import Flask, request, send_from_directory, jsonify
+from flask import request
+from flask_common import create_app, json_response, publish_openapi_spec, send_static
 from flask_swagger_ui import get_swaggerui_blueprint
-import requests
-import json
 import config
 import logging
 import IoTQbroker
 import IMQbroker
+import im_transport
+from im_transport import http_session
 import threading
-from threading import Lock
-import os
-import time  # Ensure time is imported for the test APIs
+from shared_state import IdSet
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import time
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = create_app(__name__)
+
+# Constant responses for the hot routes
+WEBHOOK_OK_RESPONSE = json_response({"ok": True})
+WEBHOOK_IGNORED_RESPONSE = json_response({"ok": True, "message": "No message in request, ignored"})
+MESSAGE_SENT_RESPONSE = json_response({"ok": True, "message": "Message sent"})
+MESSAGE_FAILED_RESPONSE = json_response({"ok": False, "message": "Failed to send message"}, 500)
+
+# Telegram chat types whose members are tracked as a device group
+GROUP_CHAT_TYPES = frozenset({"group", "supergroup"})
 
-# Store all chat_ids for broadcasting messages, with a lock for thread safety
-chat_ids = set()
-chat_ids_lock = Lock()
+# Store all chat_ids for broadcasting messages; shared through Redis when REDIS_URL is set
+chat_ids = IdSet("imtelegram:chat_ids")
+
+# Pool used by /SendBatch to contact many chats concurrently
+send_pool = ThreadPoolExecutor(max_workers=32)
+# Monotonic time of the next free /SendBatch send slot; slots are spaced to config.TELEGRAM_SEND_RATE
+# so a batch does not burst past the bot's rate limit and draw 429s
+next_send_slot = 0.0
+send_slot_lock = threading.Lock()
+
+def wait_for_send_slot():
+    global next_send_slot
+    with send_slot_lock:
+        now = time.monotonic()
+        slot = max(now, next_send_slot)
+        next_send_slot = slot + 1 / config.TELEGRAM_SEND_RATE
+    if slot > now:
+        time.sleep(slot - now)
 
 # Function: Add chat_id to the chat_ids set, thread-safe
 def add_chat_id(chat_id: str):
-    with chat_ids_lock:
-        chat_ids.add(chat_id)
-        logger.debug(f"Added chat_id={chat_id} to chat_ids set")
+    if chat_ids.add(chat_id):
+        logger.debug("Added chat_id=%s to chat_ids set", chat_id)
+
+# Bot API endpoint is fixed for the process; sends go over the shared keep-alive session
+TELEGRAM_SEND_MESSAGE_URL = f"{config.TELEGRAM_API_URL}/sendMessage"
 
 # Function: Send message to Telegram user
 def send_message(chat_id: str, text: str, user_id: str = None) -> bool:
-    url = f"https://api.telegram.org/bot{config.TELEGRAM_BOT_TOKEN}/sendMessage"
+    url = TELEGRAM_SEND_MESSAGE_URL
     payload = {
         "chat_id": chat_id,
         "text": text
     }
-    logger.debug(f"Sending Telegram message: chat_id={chat_id}, text={text}, user_id={user_id}")
+    logger.debug("Sending Telegram message: chat_id=%s, text=%s, user_id=%s", chat_id, text, user_id)
     try:
-        response = requests.post(url, json=payload, timeout=5)
-        logger.debug(f"Telegram API response: status_code={response.status_code}, text={response.text}")
+        response = http_session.post(url, json=payload, timeout=5)
+        # response.text decodes the body, so only touch it when debug logging is on
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Telegram API response: status_code=%s, text=%s", response.status_code, response.text)
         if response.status_code == 200 and response.json().get("ok"):
-            logger.info(f"Message sent successfully: chat_id={chat_id}, user_id={user_id}, text={text}")
+            logger.info("Message sent successfully: chat_id=%s, user_id=%s, text=%s", chat_id, user_id, text)
             return True
         else:
-            logger.error(f"Failed to send message: {response.text}")
+            logger.error("Failed to send message: %s", response.text)
             return False
     except Exception as e:
-        logger.error(f"Error sending message: {e}")
+        logger.error("Error sending message: %s", e)
         return False
 
 # Route: Handle Telegram Webhook request
 @app.route('/IMTelegram/webhook', methods=['POST'])
 def webhook():
-    data = request.get_json()
+    try:
+        data = json_loads(request.get_data())
+    except ValueError:
+        data = None
     if data is None:
         logger.error("Webhook request could not be parsed as JSON")
         return {"ok": False, "message": "Invalid JSON"}, 400
 
     if 'message' not in data:
         logger.warning("No message in webhook request, ignoring")
-        return {"ok": True, "message": "No message in request, ignored"}, 200
+        return WEBHOOK_IGNORED_RESPONSE
 
     message_text = data['message'].get('text', '')
     chat = data['message'].get('chat')
@@ -72,17 +109,17 @@ def webhook():
     username = data['message']['from'].get('username', data['message']['from'].get('first_name', 'User'))
     if username.startswith('@'):
         username = username[1:]
-    group_id = str(chat.get('id')) if chat.get('type') in ['group', 'supergroup'] else None
+    group_id = str(chat.get('id')) if chat.get('type') in GROUP_CHAT_TYPES else None
 
-    logger.info(f"Received message: chat_id={chat_id}, group_id={group_id}, user_id={user_id}, username={username}, text={message_text}")
+    logger.info("Received message: chat_id=%s, group_id=%s, user_id=%s, username=%s, text=%s", chat_id, group_id, user_id, username, message_text)
 
     add_chat_id(chat_id)
 
     # Call IoTQbroker to parse message and send to IOTQueue
-    device = IoTQbroker.Device("LivingRoomLight", device_id=config.DEVICE_ID, platform="telegram", chat_id=chat_id)
+    device = IoTQbroker.get_device("LivingRoomLight", config.DEVICE_ID, "telegram", chat_id)
     iot_result = IoTQbroker.IoTParse_Message(message_text, device, chat_id, "telegram", user_id=user_id, username=username)
-    logger.debug(f"IoTParse_Message result: {iot_result}")
-    return {"ok": True}, 200
+    logger.debug("IoTParse_Message result: %s", iot_result)
+    return WEBHOOK_OK_RESPONSE
 
 # Route: Manually send message to specific user
 @app.route('/IMTelegram/SendMsg', methods=['GET'])
@@ -96,7 +133,26 @@ def send_message_route():
         return {"ok": False, "message": "Missing chat_id or message"}, 400
 
     success = send_message(chat_id, message, user_id)
-    return {"ok": success, "message": "Message sent" if success else "Failed to send message"}, 200 if success else 500
+    return MESSAGE_SENT_RESPONSE if success else MESSAGE_FAILED_RESPONSE
+
+# Function: Send message to every (chat_id, platform) recipient concurrently; True only if all sends succeed
+def broadcast_message(recipients, message: str, user_id: str = None) -> bool:
+    by_platform = im_transport.group_recipients_by_platform(recipients)
+
+    futures = {}
+    for chat_id in by_platform.pop("telegram", ()):
+        futures[send_pool.submit(send_message, chat_id, message, user_id)] = (chat_id, "Telegram")
+    for platform_chat_ids in by_platform.values():
+        for chat_id in platform_chat_ids:
+            futures[send_pool.submit(im_transport.send_line, chat_id, message)] = (chat_id, "Line")
+
+    success = True
+    for future in as_completed(futures):
+        if not future.result():
+            success = False
+            chat_id, platform_name = futures[future]
+            logger.warning("Failed to send message to chat_id=%s on %s", chat_id, platform_name)
+    return success
 
 # Route: Send message to all users bound to a specific device
 @app.route('/IMTelegram/SendGroupMessage', methods=['GET'])
@@ -112,32 +168,10 @@ def send_group_message_route():
     bindings = config.load_bindings()
     bound_users = bindings.get(device_id, [])
     if not bound_users:
-        logger.warning(f"No bound users for device {device_id}")
+        logger.warning("No bound users for device %s", device_id)
         return {"ok": False, "message": "This device has no bound users"}, 404
 
-    success = True
-    for binding in bound_users:
-        chat_id = binding["chat_id"]
-        platform = binding["platform"]
-        if platform == "telegram":
-            if not send_message(chat_id, message, user_id):
-                success = False
-                logger.warning(f"Failed to send message to chat_id={chat_id} on Telegram")
-        else:  # platform == "line"
-            line_url = f"http://{config.LINE_API_HOST}:{config.LINE_API_PORT}/SendMsg"
-            params = {
-                "user_id": chat_id,
-                "message": message,
-                "bot_token": config.LINE_ACCESS_TOKEN
-            }
-            try:
-                response = requests.get(line_url, params=params, timeout=5)
-                if response.status_code != 200 or not response.json().get("ok"):
-                    success = False
-                    logger.warning(f"Failed to send message to chat_id={chat_id} on Line")
-            except requests.RequestException as e:
-                success = False
-                logger.error(f"Error sending message to chat_id={chat_id} on Line: {e}")
+    success = broadcast_message([(binding["chat_id"], binding["platform"]) for binding in bound_users], message, user_id)
 
     return {"ok": success, "message": "Group message sent" if success else "Some messages failed to send"}, 200 if success else 500
 
@@ -151,43 +185,52 @@ def send_all_message_route():
         logger.error("Missing message")
         return {"ok": False, "message": "Missing message"}, 400
 
-    all_users = set()
-    bindings = config.load_bindings()
-    for device_id in bindings:
-        for binding in bindings[device_id]:
-            all_users.add((binding["chat_id"], binding["platform"]))
+    all_users = config.load_all_bound_users()
 
     if not all_users:
         logger.warning("No users have bound any device")
         return {"ok": False, "message": "No users have bound any device"}, 404
 
-    success = True
-    for chat_id, platform in all_users:
-        if platform == "telegram":
-            if not send_message(chat_id, message, user_id):
-                success = False
-                logger.warning(f"Failed to send message to chat_id={chat_id} on Telegram")
-        else:  # platform == "line"
-            line_url = f"http://{config.LINE_API_HOST}:{config.LINE_API_PORT}/SendMsg"
-            params = {
-                "user_id": chat_id,
-                "message": message,
-                "bot_token": config.LINE_ACCESS_TOKEN
-            }
-            try:
-                response = requests.get(line_url, params=params, timeout=5)
-                if response.status_code != 200 or not response.json().get("ok"):
-                    success = False
-                    logger.warning(f"Failed to send message to chat_id={chat_id} on Line")
-            except requests.RequestException as e:
-                success = False
-                logger.error(f"Error sending message to chat_id={chat_id} on Line: {e}")
+    success = broadcast_message(all_users, message, user_id)
 
     return {"ok": success, "message": "All messages sent" if success else "Some messages failed to send"}, 200 if success else 500
 
+# Function: Send one /SendBatch item, returning its per-item status
+def send_batch_item(item) -> dict:
+    chat_id = item.get("chat_id") if isinstance(item, dict) else None
+    message = item.get("message") if isinstance(item, dict) else None
+    if not chat_id or not message:
+        logger.warning("Skipping invalid batch item: %s", item)
+        return {"chat_id": chat_id, "ok": False}
+    wait_for_send_slot()
+    return {"chat_id": chat_id, "ok": send_message(str(chat_id), message)}
+
+# Route: Send messages to many Telegram chats in a single request
+@app.route('/IMTelegram/SendBatch', methods=['POST'])
+def send_batch_route():
+    # Batches are the largest bodies this service handles; parse and encode them with orjson when available
+    try:
+        data = json_loads(request.get_data())
+    except ValueError:
+        data = None
+    items = data.get('items') if isinstance(data, dict) else None
+    if not items or not isinstance(items, list):
+        logger.error("Missing items in batch request")
+        return {"ok": False, "message": "Missing items"}, 400
+    if len(items) > config.TELEGRAM_BATCH_SIZE:
+        logger.error("Batch of %s items exceeds limit of %s", len(items), config.TELEGRAM_BATCH_SIZE)
+        return {"ok": False, "message": f"Batch exceeds {config.TELEGRAM_BATCH_SIZE} items"}, 400
+
+    results = list(send_pool.map(send_batch_item, items))
+    success = all(result["ok"] for result in results)
+    return json_response({"ok": success, "message": "Batch sent" if success else "Some messages failed to send",
+                          "results": results}, 200 if success else 500)
+
 # Swagger UI setup
 SWAGGER_URL = '/IMTelegram/swagger'
 API_URL = '/IMTelegram/static/openapi.yaml'
+# Browsers may reuse the Swagger spec for a day; ETag/Last-Modified handle revalidation
+STATIC_MAX_AGE = 86400
 swaggerui_blueprint = get_swaggerui_blueprint(
     SWAGGER_URL,
     API_URL,
@@ -200,16 +243,13 @@ app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
 # Serve openapi.yaml file
 @app.route('/IMTelegram/static/<path:path>')
 def send_swagger(path):
-    return send_from_directory('static', path)
+    return send_static(path, STATIC_MAX_AGE)
 
 # Main entry point
-if __name__ == "__main__":
+def init_service():
+    """Prepare the Swagger static files and start the Telegram queue consumer for this process."""
     # Ensure static directory and openapi.yaml exist
-    if not os.path.exists('static'):
-        os.makedirs('static')
-    with open('static/openapi.yaml', 'w') as f:
-        with open('openapi.yaml', 'r') as src:
-            f.write(src.read())
+    publish_openapi_spec()
 
     # Start IMQbroker to consume IMQueue in a thread
     imqbroker_thread = threading.Thread(target=IMQbroker.consume_telegram_queue)
@@ -217,5 +257,10 @@ if __name__ == "__main__":
     imqbroker_thread.start()
     logger.info("IMQbroker started for Telegram queue")
 
+# Development entry point; in production serve with
+#   gunicorn -c gunicorn.conf.py -b 0.0.0.0:5000 IMTelegram:app
+if __name__ == "__main__":
+    init_service()
+
     # Start Flask service
-    app.run(host="0.0.0.0", port=config.TELEGRAM_API_PORT)
\ No newline at end of file
+    app.run(host="0.0.0.0", port=config.TELEGRAM_API_PORT, threaded=True)
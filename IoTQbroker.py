@@ -1,18 +1,164 @@
-import json
-import re
 import logging
+import re
 import config
 import time
-import uuid
+import queue
+import threading
+from functools import lru_cache
+from cachetools import TTLCache
 import pika
+import broker
+from im_transport import send_message, send_many, group_recipients_by_platform
+
+try:
+    from orjson import dumps as json_dumps
+except ImportError:
+    from json import dumps as json_dumps
 
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Global client pool, used to reuse RabbitMQ channels by chat_id
-client_pool = {}
+class BatchPublisher:
+    """
+    Publishes queued RabbitMQ messages from one background thread in transactional batches.
+    Callers only enqueue, so a Flask request never waits on the broker; the thread drains up to
+    batch_size messages, publishes them and commits once with tx_commit, one broker round trip
+    per batch instead of one confirm per message.
+    """
+    def __init__(self, batch_size: int, maxsize: int = 10000, put_timeout: float = 0):
+        self.batch_size = batch_size
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._connection = None
+        self._channel = None
+        self._declared = set()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def publish(self, queue_name: str, body: bytes) -> bool:
+        """Queue body for queue_name, waiting up to put_timeout for room; False only if the buffer stays full."""
+        self._ensure_started()
+        try:
+            # A full buffer means the broker is lagging; block the caller briefly instead of dropping at once
+            self._queue.put((queue_name, body), block=self.put_timeout > 0, timeout=self.put_timeout)
+            return True
+        except queue.Full:
+            logger.error("RabbitMQ publish buffer is full, dropping message for queue=%s", queue_name)
+            return False
+
+    def _ensure_started(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    thread = threading.Thread(target=self._run, name="rabbitmq-publisher", daemon=True)
+                    thread.start()
+                    self._thread = thread
+
+    def _connect(self):
+        self._connection, self._channel = broker.connect()
+        self._channel.tx_select()
+        self._declared = set()
+        logger.info("Opened RabbitMQ publisher channel: host=%s, port=%s", config.RABBITMQ_HOST, config.RABBITMQ_PORT)
+
+    def _close(self):
+        try:
+            if self._connection is not None and not self._connection.is_closed:
+                self._connection.close()
+        except Exception as e:
+            logger.debug("Error closing RabbitMQ publisher connection: %s", e)
+        self._connection = None
+        self._channel = None
+
+    def _run(self):
+        while True:
+            try:
+                batch = [self._queue.get(timeout=5)]
+            except queue.Empty:
+                # Service heartbeats while idle so the broker does not drop the connection
+                if self._connection is not None and self._connection.is_open:
+                    try:
+                        self._connection.process_data_events(time_limit=0)
+                    except Exception as e:
+                        logger.warning("RabbitMQ publisher connection lost while idle: %s", e)
+                        self._close()
+                continue
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._publish_batch(batch)
+
+    def _publish_batch(self, batch: list, max_retries: int = 6):
+        for attempt in range(max_retries):
+            try:
+                if self._connection is None or not self._connection.is_open:
+                    self._connect()
+                for queue_name, body in batch:
+                    if queue_name not in self._declared:
+                        broker.declare_command_queue(self._channel, queue_name)
+                        self._declared.add(queue_name)
+                    self._channel.basic_publish(
+                        exchange='',
+                        routing_key=queue_name,
+                        body=body,
+                        properties=broker.COMMAND_PROPERTIES
+                    )
+                self._channel.tx_commit()
+                logger.info("RabbitMQ batch of %s messages published", len(batch))
+                return
+            except pika.exceptions.AMQPError as e:
+                # Uncommitted publishes are discarded with the channel, so the whole batch is retried
+                logger.warning("RabbitMQ batch publish failed (attempt %s/%s): %s", attempt + 1, max_retries, e)
+                self._close()
+                # Back off 1, 2, 4, ... seconds; new commands keep buffering in the queue meanwhile
+                if attempt < max_retries - 1:
+                    time.sleep(min(broker.RECONNECT_MAX_BACKOFF, 2 ** attempt))
+            except Exception as e:
+                logger.error("Unexpected error publishing RabbitMQ batch: %s", e)
+                self._close()
+                break
+        logger.error("Dropped RabbitMQ batch of %s messages", len(batch))
+
+publisher = BatchPublisher(config.RABBITMQ_PUBLISH_BATCH_SIZE, config.RABBITMQ_PUBLISH_BUFFER,
+                           config.RABBITMQ_PUBLISH_TIMEOUT)
+
+class DeviceGroup:
+    """Group chat membership for one device_id, shared by every Device object created for that id."""
+    def __init__(self):
+        self.group_id = None
+        # (chat_id, platform) pairs; replaced rather than mutated, so readers on other threads can
+        # iterate it without a lock
+        self.members = frozenset()
+        # Bumped whenever members changes so cached recipient lists know to rebuild
+        self.version = 0
+        self.lock = threading.Lock()
+
+    def join(self, chat_id: str, platform: str):
+        """Add chat_id; return the members it joined (empty if it created the group), or None if already in."""
+        member = (chat_id, platform)
+        with self.lock:
+            if member in self.members:
+                return None
+            existing = self.members
+            if self.group_id is None:
+                self.group_id = chat_id
+            self.members = existing | {member}
+            self.version += 1
+            return existing
+
+# device_id -> DeviceGroup; get_device caches one Device per chat, so membership must not live on it
+device_groups = {}
+device_groups_lock = threading.Lock()
+
+def get_device_group(device_id: str) -> DeviceGroup:
+    with device_groups_lock:
+        group = device_groups.get(device_id)
+        if group is None:
+            group = device_groups[device_id] = DeviceGroup()
+        return group
 
 class Device:
     def __init__(self, name: str, device_id: str = config.DEVICE_ID, platform: str = "unknown", chat_id: str = None):
@@ -20,37 +166,54 @@ class Device:
         self.device_id = device_id
         self.chat_id = chat_id
         self.platform = platform
-        self.group_id = None
-        self.group_members = set()
+        self.group = get_device_group(device_id)
         self.manufacturer = "raspberrypi" if "raspberrypi" in device_id else "esp32"
         self.device_type = "light" if "light" in device_id else "fan"
-        logger.info(f"Initializing device: device_id={device_id}, manufacturer={self.manufacturer}, device_type={self.device_type}")
-        try:
-            self.message_api = MessageAPI(config.RABBITMQ_HOST, config.RABBITMQ_PORT, platform, device_id, chat_id)
-        except Exception as e:
-            logger.error(f"Failed to initialize MessageAPI for device {device_id}: {e}")
-            raise
+        # Commands for this device always go to its own queue
+        self.queue_name = broker.command_queue(self.manufacturer, device_id)
+        logger.info("Initializing device: device_id=%s, manufacturer=%s, device_type=%s", device_id, self.manufacturer, self.device_type)
+        self.message_api = message_api
+        # Fields every command message for this device shares; see build_command
+        self.command_templates = {command: {"command": command, "device_id": device_id} for command in ("on", "off", "get_status")}
+
+    @property
+    def group_id(self) -> str:
+        return self.group.group_id
+
+    @property
+    def group_members(self) -> frozenset:
+        return self.group.members
+
+    @property
+    def members_version(self) -> int:
+        return self.group.version
+
+    def build_command(self, command: str, chat_id: str, platform: str, user_id: str, username: str, bot_token: str) -> dict:
+        message = self.command_templates[command].copy()
+        message["chat_id"] = chat_id
+        message["platform"] = platform
+        message["user_id"] = user_id
+        message["username"] = username
+        message["bot_token"] = bot_token or (config.TELEGRAM_BOT_TOKEN if platform == "telegram" else config.LINE_ACCESS_TOKEN)
+        return message
 
     def bind_user(self, chat_id: str, platform: str) -> bool:
         try:
             if config.save_binding(self.device_id, chat_id, platform):
-                if self.group_id is None:
-                    self.group_id = chat_id
-                    self.group_members.add(chat_id)
-                    logger.info(f"User chat_id={chat_id} created group for device {self.device_id}")
-                else:
-                    if chat_id not in self.group_members:
-                        self.group_members.add(chat_id)
-                        logger.info(f"User chat_id={chat_id} joined group for device {self.device_id}")
-                        from IMQbroker import send_message
-                        for member in self.group_members:
-                            if member != chat_id:
-                                send_message(member, f"User {chat_id} has joined the group for device {self.device_id}", platform)
+                others = self.group.join(chat_id, platform)
+                if others is not None and not others:
+                    logger.info("User chat_id=%s created group for device %s", chat_id, self.device_id)
+                elif others:
+                    logger.info("User chat_id=%s joined group for device %s", chat_id, self.device_id)
+                    notice = f"User {chat_id} has joined the group for device {self.device_id}"
+                    # Each member is told on its own platform, not the joining user's
+                    for member_platform, member_chat_ids in group_recipients_by_platform(others).items():
+                        send_many(member_chat_ids, notice, member_platform)
                 return True
             else:
                 return False
         except Exception as e:
-            logger.error(f"Failed to bind user chat_id={chat_id} to device {self.device_id}: {e}")
+            logger.error("Failed to bind user chat_id=%s to device %s: %s", chat_id, self.device_id, e)
             return False
 
     def get_bound_users(self) -> set:
@@ -59,153 +222,144 @@ class Device:
             bound_users = set()
             for binding in bindings.get(self.device_id, []):
                 bound_users.add((binding["chat_id"], binding["platform"]))
-            logger.info(f"Retrieved bound users for device {self.device_id}: {bound_users}")
+            logger.debug("Retrieved bound users for device %s: %s", self.device_id, bound_users)
             return bound_users
         except Exception as e:
-            logger.error(f"Failed to retrieve bound users for device {self.device_id}: {e}")
+            logger.error("Failed to retrieve bound users for device %s: %s", self.device_id, e)
             return set()
 
     def get_all_bound_users(self) -> set:
         try:
-            bindings = config.load_bindings()
-            all_users = set()
-            for device_id in bindings:
-                for binding in bindings[device_id]:
-                    all_users.add((binding["chat_id"], binding["platform"]))
-            logger.info(f"Retrieved all bound users: {all_users}")
+            all_users = set(config.load_all_bound_users())
+            logger.debug("Retrieved all bound users: %s", all_users)
             return all_users
         except Exception as e:
-            logger.error(f"Failed to retrieve all bound users: {e}")
+            logger.error("Failed to retrieve all bound users: %s", e)
             return set()
 
     def enable(self, chat_id: str = None, platform: str = "telegram", user_id: str = None, username: str = None, bot_token: str = None) -> bool:
-        queue_name = f"iot_{self.manufacturer}_queue"
-        message = {
-            "command": "on",
-            "chat_id": chat_id,
-            "platform": platform,
-            "device_id": self.device_id,
-            "user_id": user_id,
-            "username": username,
-            "bot_token": bot_token or (config.TELEGRAM_BOT_TOKEN if platform == "telegram" else config.LINE_ACCESS_TOKEN)
-        }
+        queue_name = self.queue_name
+        body = encode_command(self, "on", chat_id, platform, user_id, username, bot_token)
         try:
-            logger.info(f"Sending enable command: queue={queue_name}, message={json.dumps(message)}")
-            return self.message_api.send_message(queue_name, message)
+            logger.info("Sending enable command: device_id=%s, chat_id=%s, queue=%s", self.device_id, chat_id, queue_name)
+            return self.message_api.send_encoded(queue_name, body, chat_id)
         except Exception as e:
-            logger.error(f"Failed to enable device {self.device_id} on queue {queue_name}: {e}")
+            logger.error("Failed to enable device %s on queue %s: %s", self.device_id, queue_name, e)
             return False
 
     def disable(self, chat_id: str = None, platform: str = "telegram", user_id: str = None, username: str = None, bot_token: str = None) -> bool:
-        queue_name = f"iot_{self.manufacturer}_queue"
-        message = {
-            "command": "off",
-            "chat_id": chat_id,
-            "platform": platform,
-            "device_id": self.device_id,
-            "user_id": user_id,
-            "username": username,
-            "bot_token": bot_token or (config.TELEGRAM_BOT_TOKEN if platform == "telegram" else config.LINE_ACCESS_TOKEN)
-        }
+        queue_name = self.queue_name
+        body = encode_command(self, "off", chat_id, platform, user_id, username, bot_token)
         try:
-            logger.info(f"Sending disable command: queue={queue_name}, message={json.dumps(message)}")
-            return self.message_api.send_message(queue_name, message)
+            logger.info("Sending disable command: device_id=%s, chat_id=%s, queue=%s", self.device_id, chat_id, queue_name)
+            return self.message_api.send_encoded(queue_name, body, chat_id)
         except Exception as e:
-            logger.error(f"Failed to disable device {self.device_id} on queue {queue_name}: {e}")
+            logger.error("Failed to disable device %s on queue %s: %s", self.device_id, queue_name, e)
             return False
 
     def get_status(self, chat_id: str = None, platform: str = "telegram", user_id: str = None, username: str = None, bot_token: str = None) -> bool:
-        queue_name = f"iot_{self.manufacturer}_queue"
-        message = {
-            "command": "get_status",
-            "chat_id": chat_id,
-            "platform": platform,
-            "device_id": self.device_id,
-            "user_id": user_id,
-            "username": username,
-            "bot_token": bot_token or (config.TELEGRAM_BOT_TOKEN if platform == "telegram" else config.LINE_ACCESS_TOKEN)
-        }
+        queue_name = self.queue_name
+        body = encode_command(self, "get_status", chat_id, platform, user_id, username, bot_token)
         try:
-            logger.info(f"Sending get status command: queue={queue_name}, message={json.dumps(message)}")
-            return self.message_api.send_message(queue_name, message)
+            logger.info("Sending get status command: device_id=%s, chat_id=%s, queue=%s", self.device_id, chat_id, queue_name)
+            return self.message_api.send_encoded(queue_name, body, chat_id)
         except Exception as e:
-            logger.error(f"Failed to get status for device {self.device_id} on queue {queue_name}: {e}")
+            logger.error("Failed to get status for device %s on queue %s: %s", self.device_id, queue_name, e)
             return False
 
+# The same chat usually repeats the same few commands, so keep their JSON bodies ready to publish
+@lru_cache(maxsize=4096)
+def encode_command(device: Device, command: str, chat_id: str, platform: str, user_id: str, username: str, bot_token: str) -> bytes:
+    body = json_dumps(device.build_command(command, chat_id, platform, user_id, username, bot_token))
+    return body.encode() if isinstance(body, str) else body
+
+@lru_cache(maxsize=4096)
+def get_device(name: str, device_id: str = config.DEVICE_ID, platform: str = "unknown", chat_id: str = None) -> Device:
+    """Return a shared Device for the given arguments instead of constructing one per message."""
+    return Device(name, device_id=device_id, platform=platform, chat_id=chat_id)
+
 class MessageAPI:
-    def __init__(self, broker_host: str, broker_port: int, platform: str, device_id: str, chat_id: str):
+    def __init__(self, broker_host: str, broker_port: int):
         self.broker_host = broker_host
         self.broker_port = broker_port
-        self.device_id = device_id
-        self.platform = platform
-        self.chat_id = chat_id or "default"
-        self.connection = None
-        self.channel = None
-        if self.chat_id in client_pool:
-            self.channel = client_pool[self.chat_id]
-            logger.info(f"Reusing RabbitMQ channel, chat_id={self.chat_id}")
-        else:
-            try:
-                client_id = f"iotq_broker_{platform}_{self.chat_id}_{str(uuid.uuid4())[:8]}"
-                self._reconnect(client_id)
-                client_pool[self.chat_id] = self.channel
-                logger.info(f"Created new RabbitMQ channel, chat_id={self.chat_id}, client_id={client_id}")
-            except Exception as e:
-                logger.error(f"Failed to create RabbitMQ channel, chat_id={self.chat_id}: {e}")
-                raise
-
-    def _reconnect(self, client_id: str = None):
-        try:
-            if self.connection and not self.connection.is_closed:
-                self.connection.close()
-            parameters = pika.ConnectionParameters(host=self.broker_host, port=self.broker_port)
-            self.connection = pika.BlockingConnection(parameters)
-            self.channel = self.connection.channel()
-            logger.info(f"Reconnected RabbitMQ channel, chat_id={self.chat_id}, client_id={client_id}")
-        except Exception as e:
-            logger.error(f"Failed to reconnect RabbitMQ channel, chat_id={self.chat_id}: {e}")
-            raise
+        # (queue_name, chat_id) -> body of the chat's last queued command, so repeated taps are published once
+        self.recent_commands = TTLCache(maxsize=4096, ttl=config.COMMAND_DEDUP_WINDOW) if config.COMMAND_DEDUP_WINDOW > 0 else None
+        self.recent_commands_lock = threading.Lock()
 
     def send_message(self, queue_name: str, message: dict) -> bool:
-        try:
-            if not self.connection or self.connection.is_closed or not self.channel or self.channel.is_closed:
-                logger.info(f"RabbitMQ connection or channel closed, reconnecting for chat_id={self.chat_id}")
-                self._reconnect()
-            self.channel.queue_declare(queue=queue_name, durable=True)
-            self.channel.basic_publish(
-                exchange='',
-                routing_key=queue_name,
-                body=json.dumps(message),
-                properties=pika.BasicProperties(delivery_mode=2)
-            )
-            logger.info(f"RabbitMQ message sent successfully: queue={queue_name}, message={json.dumps(message)}")
+        return self.send_encoded(queue_name, json_dumps(message), message.get("chat_id"))
+
+    def send_encoded(self, queue_name: str, body: bytes, chat_id: str = None) -> bool:
+        """Queue an already serialized message body for publishing."""
+        if self.recent_commands is not None:
+            # Only a repeat of the chat's last command is dropped; on -> off -> on publishes all three
+            key = (queue_name, chat_id)
+            with self.recent_commands_lock:
+                if self.recent_commands.get(key) == body:
+                    logger.debug("Dropping duplicate command for queue=%s within %ss", queue_name, config.COMMAND_DEDUP_WINDOW)
+                    return True
+                self.recent_commands[key] = body
+        if publisher.publish(queue_name, body):
+            logger.debug("RabbitMQ message queued for publishing: queue=%s, bytes=%s", queue_name, len(body))
             return True
-        except Exception as e:
-            logger.error(f"Failed to send RabbitMQ message: queue={queue_name}, error={e}")
-            return False
+        return False
 
-    def stop(self):
-        try:
-            if self.connection and not self.connection.is_closed:
-                self.connection.close()
-            logger.info(f"RabbitMQ connection stopped for chat_id={self.chat_id}")
-        except Exception as e:
-            logger.error(f"Failed to stop RabbitMQ connection for chat_id={self.chat_id}: {e}")
+# Shared by every Device; chat and device ids travel in the message body, not in the API object
+message_api = MessageAPI(config.RABBITMQ_HOST, config.RABBITMQ_PORT)
+
+# First-contact messages answered with the help text before any command parsing
+GREETINGS = frozenset({"hi", "hello", "/start"})
+
+# Command words -> action. Commands are fixed literals, so a dict probe replaces regex matching;
+# an optional trailing token names the target device.
+COMMANDS = {
+    "/bind": "bind",
+    "turn on": "enable",
+    "/enable": "enable",
+    "turn off": "disable",
+    "/disable": "disable",
+    "get status": "status",
+    "/status": "status",
+}
+
+# Device ids accepted after a command word, as in the original command grammar
+DEVICE_ID_PATTERN = re.compile(r"[\w_]+")
+
+# Device actions -> (Device method, reported action, failure reply prefix, failure result message)
+DEVICE_ACTIONS = {
+    "enable": (Device.enable, "Enable", "Failed to enable device", "Failed to enable device"),
+    "disable": (Device.disable, "Disable", "Failed to disable device", "Failed to disable device"),
+    "status": (Device.get_status, "GetStatus", "Failed to get status of device", "Failed to get device status"),
+}
+
+# Pure function of the normalized text; bots see the same few commands over and over
+@lru_cache(maxsize=256)
+def split_command(message_text: str) -> tuple:
+    """Return (action, device_id) for a lowercased command, or (None, None) if it is not one."""
+    action = COMMANDS.get(message_text)
+    if action and action != "bind":
+        return action, None
+    # Only the last whitespace-separated token can be a device id
+    parts = message_text.rsplit(None, 1)
+    if len(parts) == 2 and DEVICE_ID_PATTERN.fullmatch(parts[1]):
+        action = COMMANDS.get(parts[0])
+        if action:
+            return action, parts[1]
+    return None, None
 
 def IoTParse_Message(message_text: str, device: Device, chat_id: str, platform: str = "telegram", user_id: str = None, username: str = None) -> dict:
     message_text = message_text.lower().strip()
-    logger.info(f"Parsing IoT message: {message_text}, username={username}, platform={platform}, user_id={user_id}, chat_id={chat_id}")
+    logger.info("Parsing IoT message: %s, username=%s, platform=%s, user_id=%s, chat_id=%s", message_text, username, platform, user_id, chat_id)
     try:
         if not username:
             username = "User"
-            logger.warning(f"No username provided, using default: {username}, chat_id={chat_id}")
+            logger.warning("No username provided, using default: %s, chat_id=%s", username, chat_id)
         if not user_id:
             user_id = "Unknown"
-            logger.warning(f"No user_id provided, using default: {user_id}, chat_id={chat_id}")
+            logger.warning("No user_id provided, using default: %s, chat_id=%s", user_id, chat_id)
         bot_token = config.TELEGRAM_BOT_TOKEN if platform == "telegram" else config.LINE_ACCESS_TOKEN
-        from IMQbroker import send_message
 
-        if message_text in ["hi", "hello", "/start"]:
+        if message_text in GREETINGS:
             help_text = (
                 f"Hi, {username}\n"
                 "This is an IoT control bot\n"
@@ -218,13 +372,13 @@ def IoTParse_Message(message_text: str, device: Device, chat_id: str, platform:
             send_message(chat_id, help_text, platform, user_id=user_id, username=username)
             return {"success": True, "action": "Help"}
 
-        bind_match = re.match(r"^/bind\s+([\w_]+)$", message_text)
-        if bind_match:
-            device_id = bind_match.group(1)
+        action, requested_device_id = split_command(message_text)
+        if action == "bind":
+            device_id = requested_device_id
             if device_id not in config.SUPPORTED_DEVICES:
-                send_message(chat_id, f"Invalid device ID: {device_id}. Available devices: {', '.join(config.SUPPORTED_DEVICES)}", platform, user_id=user_id, username=username)
+                send_message(chat_id, f"Invalid device ID: {device_id}. Available devices: {config.SUPPORTED_DEVICES_STR}", platform, user_id=user_id, username=username)
                 return {"success": False, "message": "Invalid device ID"}
-            target_device = Device(device.name, device_id=device_id, platform=platform, chat_id=chat_id)
+            target_device = get_device(device.name, device_id, platform, chat_id)
             if target_device.bind_user(chat_id, platform):
                 send_message(chat_id, f"Successfully bound to device {device_id}", platform, user_id=user_id, username=username)
                 return {"success": True, "action": "Bind", "device_id": device_id}
@@ -232,51 +386,25 @@ def IoTParse_Message(message_text: str, device: Device, chat_id: str, platform:
                 send_message(chat_id, f"Failed to bind to device {device_id}", platform, user_id=user_id, username=username)
                 return {"success": False, "message": "Failed to bind to device"}
 
-        enable_match = re.match(r"^(turn on|/enable)(\s+([\w_]+))?$", message_text)
-        disable_match = re.match(r"^(turn off|/disable)(\s+([\w_]+))?$", message_text)
-        status_match = re.match(r"^(get status|/status)(\s+([\w_]+))?$", message_text)
-
-        device_id = None
-        if enable_match and enable_match.group(3):
-            device_id = enable_match.group(3)
-        elif disable_match and disable_match.group(3):
-            device_id = disable_match.group(3)
-        elif status_match and status_match.group(3):
-            device_id = status_match.group(3)
-        else:
-            device_id = device.device_id
+        device_id = requested_device_id or device.device_id
 
         if device_id not in config.SUPPORTED_DEVICES:
-            send_message(chat_id, f"Invalid device ID: {device_id}. Available devices: {', '.join(config.SUPPORTED_DEVICES)}", platform, user_id=user_id, username=username)
+            send_message(chat_id, f"Invalid device ID: {device_id}. Available devices: {config.SUPPORTED_DEVICES_STR}", platform, user_id=user_id, username=username)
             return {"success": False, "message": "Invalid device ID"}
 
-        target_device = Device(device.name, device_id=device_id, platform=platform, chat_id=chat_id)
+        target_device = get_device(device.name, device_id, platform, chat_id)
 
-        if enable_match:
-            if target_device.enable(chat_id, platform, user_id, username, bot_token):
-                # Remove "Command received" reply
-                return {"success": True, "action": "Enable", "device_id": device_id}
-            else:
-                send_message(chat_id, f"Failed to enable device {device_id}", platform, user_id=user_id, username=username)
-                return {"success": False, "message": "Failed to enable device"}
-        elif disable_match:
-            if target_device.disable(chat_id, platform, user_id, username, bot_token):
+        handler = DEVICE_ACTIONS.get(action)
+        if handler:
+            method, action_name, failure_reply, failure_message = handler
+            if method(target_device, chat_id, platform, user_id, username, bot_token):
                 # Remove "Command received" reply
-                return {"success": True, "action": "Disable", "device_id": device_id}
-            else:
-                send_message(chat_id, f"Failed to disable device {device_id}", platform, user_id=user_id, username=username)
-                return {"success": False, "message": "Failed to disable device"}
-        elif status_match:
-            if target_device.get_status(chat_id, platform, user_id, username, bot_token):
-                # Remove "Command received" reply
-                return {"success": True, "action": "GetStatus", "device_id": device_id}
-            else:
-                send_message(chat_id, f"Failed to get status of device {device_id}", platform, user_id=user_id, username=username)
-                return {"success": False, "message": "Failed to get device status"}
-        else:
-            send_message(chat_id, "Invalid command. Please use /start to view help.", platform, user_id=user_id, username=username)
-            return {"success": False, "message": "Invalid command"}
+                return {"success": True, "action": action_name, "device_id": device_id}
+            send_message(chat_id, f"{failure_reply} {device_id}", platform, user_id=user_id, username=username)
+            return {"success": False, "message": failure_message}
+        send_message(chat_id, "Invalid command. Please use /start to view help.", platform, user_id=user_id, username=username)
+        return {"success": False, "message": "Invalid command"}
     except Exception as e:
-        logger.error(f"Error parsing message '{message_text}', username={username}, user_id={user_id}, chat_id={chat_id}: {e}", exc_info=True)
+        logger.error("Error parsing message '%s', username=%s, user_id=%s, chat_id=%s: %s", message_text, username, user_id, chat_id, e, exc_info=True)
         send_message(chat_id, "An error occurred while processing your command. Please try again.", platform, user_id=user_id, username=username)
         return {"success": False, "message": "Error processing command"}
\ No newline at end of file
@@ -0,0 +1,48 @@
+# broker.py
+# Shared RabbitMQ connection factory for the IM services, IoTQbroker and the device services
+import pika
+import config
+
+# Every connection in the system talks to the same broker with the same heartbeat and
+# blocked-connection timeout, so the parameters are built once per process
+CONNECTION_PARAMETERS = pika.ConnectionParameters(
+    host=config.RABBITMQ_HOST,
+    port=config.RABBITMQ_PORT,
+    heartbeat=config.RABBITMQ_HEARTBEAT,
+    blocked_connection_timeout=60
+)
+
+# Upper bound in seconds for every reconnect backoff loop during a broker outage
+RECONNECT_MAX_BACKOFF = config.RABBITMQ_RECONNECT_MAX
+
+# Persistent delivery for every published message
+PERSISTENT = pika.BasicProperties(delivery_mode=2)
+TRANSIENT = pika.BasicProperties(delivery_mode=1)
+# Delivery mode for device commands, pinned explicitly rather than left to the client default
+COMMAND_PROPERTIES = PERSISTENT if config.RABBITMQ_COMMAND_PERSISTENT else TRANSIENT
+
+# Header naming the event type, so consumers can skip events they ignore without decoding the body
+EVENT_HEADER = "x-event"
+STATUS_UPDATE = "status_update"
+STATUS_UPDATE_PROPERTIES = pika.BasicProperties(delivery_mode=2, headers={EVENT_HEADER: STATUS_UPDATE})
+# IM platform -> queue its status updates are published to
+STATUS_QUEUES = {"line": config.RABBITMQ_LINE_QUEUE, "telegram": config.RABBITMQ_TELEGRAM_QUEUE}
+
+# Arguments of every command queue; the publisher and the device service must declare them alike
+COMMAND_QUEUE_ARGUMENTS = {
+    "x-message-ttl": config.RABBITMQ_COMMAND_TTL * 1000,
+    "x-max-length": config.RABBITMQ_COMMAND_QUEUE_MAX,
+}
+
+def command_queue(manufacturer: str, device_id: str) -> str:
+    """Name of the queue carrying commands for one device, so a device only receives its own commands."""
+    return f"iot_{manufacturer}_{device_id}_queue"
+
+def declare_command_queue(channel, queue_name: str):
+    """Declare a device command queue, bounded so commands for a device nobody consumes expire."""
+    channel.queue_declare(queue=queue_name, durable=True, arguments=COMMAND_QUEUE_ARGUMENTS)
+
+def connect():
+    """Open a BlockingConnection to the broker and return (connection, channel)."""
+    connection = pika.BlockingConnection(CONNECTION_PARAMETERS)
+    return connection, connection.channel()
@@ -4,9 +4,16 @@ import logging
 import threading
 import time
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Configure logging; LOG_LEVEL=WARNING drops the per-request info lines in production
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# getLevelName maps a known level name to its number; anything else would make basicConfig raise
+_invalid_log_level = None
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    _invalid_log_level, LOG_LEVEL = LOG_LEVEL, 'INFO'
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
+if _invalid_log_level is not None:
+    logger.error("Invalid log level for LOG_LEVEL: %r. Using default INFO.", _invalid_log_level)
 
 # Thread-safe lock for configuration access
 config_lock = threading.Lock()
@@ -16,6 +23,8 @@ _last_modified = 0
 _cached_config = None
 _bindings_last_modified = 0
 _cached_bindings = None
+_all_bound_users_source = None
+_cached_all_bound_users = frozenset()
 
 def load_device_config(file_path=None):
     """
@@ -45,13 +54,13 @@ def load_device_config(file_path=None):
         mtime = os.path.getmtime(file_path) if os.path.exists(file_path) else 0
         with config_lock:
             if mtime > _last_modified:
-                logger.debug(f"Checked file {file_path}, mtime: {mtime}, last_modified: {_last_modified}")
-                logger.info(f"Config file {file_path} modified or first load, reloading...")
+                logger.debug("Checked file %s, mtime: %s, last_modified: %s", file_path, mtime, _last_modified)
+                logger.info("Config file %s modified or first load, reloading...", file_path)
                 if not os.path.exists(file_path):
-                    logger.warning(f"Config file not found at {file_path}. Creating with default values.")
+                    logger.warning("Config file not found at %s. Creating with default values.", file_path)
                     with open(file_path, 'w') as f:
                         json.dump(default_config, f, indent=4)
-                    logger.info(f"Created default config file at {file_path}")
+                    logger.info("Created default config file at %s", file_path)
                     config_data = default_config
                 else:
                     with open(file_path, 'r') as f:
@@ -59,7 +68,7 @@ def load_device_config(file_path=None):
                     
                     for device in ["esp32", "raspberry_pi"]:
                         if device not in config_data:
-                            logger.error(f"Missing '{device}' configuration. Using default values.")
+                            logger.error("Missing '%s' configuration. Using default values.", device)
                             config_data = default_config
                             break
                         # Support legacy host/port format
@@ -68,38 +77,47 @@ def load_device_config(file_path=None):
                                 config_data[device]["port"] = int(config_data[device]["port"])
                                 config_data[device]["url"] = f"http://{config_data[device]['host']}:{config_data[device]['port']}"
                             except (TypeError, ValueError):
-                                logger.error(f"Invalid port for '{device}'. Using default values.")
+                                logger.error("Invalid port for '%s'. Using default values.", device)
                                 config_data = default_config
                                 break
                         elif "url" not in config_data[device]:
-                            logger.error(f"Missing 'url' or valid 'host/port' for '{device}'. Using default values.")
+                            logger.error("Missing 'url' or valid 'host/port' for '%s'. Using default values.", device)
                             config_data = default_config
                             break
                 
                 _cached_config = config_data
                 _last_modified = mtime
-                logger.debug(f"Loaded config: {_cached_config}")
+                logger.debug("Loaded config: %s", _cached_config)
             else:
                 if _cached_config is None:
                     logger.warning("No cached config, loading default...")
                     _cached_config = default_config
-                logger.debug(f"Config unchanged: {file_path}, mtime: {mtime}")
+                logger.debug("Config unchanged: %s, mtime: %s", file_path, mtime)
         
         return _cached_config.copy()
     
     except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON format in {file_path}: {e}. Using default values.")
+        logger.error("Invalid JSON format in %s: %s. Using default values.", file_path, e)
         with config_lock:
             _cached_config = default_config
             _last_modified = mtime
         return default_config
     except Exception as e:
-        logger.error(f"Error loading config from {file_path}: {e}. Using default values.")
+        logger.error("Error loading config from %s: %s. Using default values.", file_path, e)
         with config_lock:
             _cached_config = default_config
             _last_modified = mtime
         return default_config
 
+def get_device_config():
+    """
+    Return the device configuration kept current by the polling thread, without touching the disk.
+    Returns:
+        dict: The shared cached configuration; callers must not mutate it.
+    """
+    config_data = _cached_config
+    return config_data if config_data is not None else load_device_config()
+
 def load_bindings(file_path=None):
     """
     Load bindings from a JSON file.
@@ -118,13 +136,13 @@ def load_bindings(file_path=None):
         mtime = os.path.getmtime(file_path) if os.path.exists(file_path) else 0
         with config_lock:
             if mtime > _bindings_last_modified:
-                logger.debug(f"Checked bindings file {file_path}, mtime: {mtime}, last_modified: {_bindings_last_modified}")
-                logger.info(f"Bindings file {file_path} modified or first load, reloading...")
+                logger.debug("Checked bindings file %s, mtime: %s, last_modified: %s", file_path, mtime, _bindings_last_modified)
+                logger.info("Bindings file %s modified or first load, reloading...", file_path)
                 if not os.path.exists(file_path):
-                    logger.warning(f"Bindings file not found at {file_path}. Creating with default values.")
+                    logger.warning("Bindings file not found at %s. Creating with default values.", file_path)
                     with open(file_path, 'w') as f:
                         json.dump(default_bindings, f, indent=4)
-                    logger.info(f"Created default bindings file at {file_path}")
+                    logger.info("Created default bindings file at %s", file_path)
                     bindings_data = default_bindings
                 else:
                     with open(file_path, 'r') as f:
@@ -133,39 +151,69 @@ def load_bindings(file_path=None):
                     # Validate bindings data
                     for device_id in bindings_data:
                         if not isinstance(bindings_data[device_id], list):
-                            logger.error(f"Invalid bindings format for device {device_id}. Using default values.")
+                            logger.error("Invalid bindings format for device %s. Using default values.", device_id)
                             bindings_data = default_bindings
                             break
                         for binding in bindings_data[device_id]:
                             if not all(key in binding for key in ["chat_id", "platform"]):
-                                logger.error(f"Invalid binding entry for device {device_id}. Using default values.")
+                                logger.error("Invalid binding entry for device %s. Using default values.", device_id)
                                 bindings_data = default_bindings
                                 break
                     
                 _cached_bindings = bindings_data
                 _bindings_last_modified = mtime
-                logger.debug(f"Loaded bindings: {_cached_bindings}")
+                logger.debug("Loaded bindings: %s", _cached_bindings)
             else:
                 if _cached_bindings is None:
                     logger.warning("No cached bindings, loading default...")
                     _cached_bindings = default_bindings
-                logger.debug(f"Bindings unchanged: {file_path}, mtime: {mtime}")
+                logger.debug("Bindings unchanged: %s, mtime: %s", file_path, mtime)
         
         return _cached_bindings.copy()
     
     except json.JSONDecodeError as e:
-        logger.error(f"Invalid JSON format in {file_path}: {e}. Using default values.")
+        logger.error("Invalid JSON format in %s: %s. Using default values.", file_path, e)
         with config_lock:
             _cached_bindings = default_bindings
             _bindings_last_modified = mtime
         return default_bindings
     except Exception as e:
-        logger.error(f"Error loading bindings from {file_path}: {e}. Using default values.")
+        logger.error("Error loading bindings from %s: %s. Using default values.", file_path, e)
         with config_lock:
             _cached_bindings = default_bindings
             _bindings_last_modified = mtime
         return default_bindings
 
+def load_bindings_shared(file_path=None):
+    """
+    Like load_bindings, but return the cached dict itself instead of a copy.
+    Callers must not mutate it; its identity changes only when the bindings are reloaded,
+    so it can key caches derived from the bindings.
+    """
+    load_bindings(file_path)
+    with config_lock:
+        return _cached_bindings
+
+def load_all_bound_users(file_path=None):
+    """
+    Get every (chat_id, platform) pair bound to any device.
+    Args:
+        file_path (str, optional): Path to the bindings file. Defaults to ~/Desktop/bindings.json.
+    Returns:
+        frozenset: Bound (chat_id, platform) pairs, rebuilt only when the bindings are reloaded.
+    """
+    global _all_bound_users_source, _cached_all_bound_users
+    load_bindings(file_path)
+    with config_lock:
+        if _cached_bindings is not _all_bound_users_source:
+            _cached_all_bound_users = frozenset(
+                (binding["chat_id"], binding["platform"])
+                for device_bindings in _cached_bindings.values()
+                for binding in device_bindings
+            )
+            _all_bound_users_source = _cached_bindings
+        return _cached_all_bound_users
+
 def save_binding(device_id: str, chat_id: str, platform: str, file_path=None):
     """
     Save a new binding to the bindings file.
@@ -182,26 +230,29 @@ def save_binding(device_id: str, chat_id: str, platform: str, file_path=None):
     
     try:
         bindings_data = load_bindings(file_path)
-        if device_id not in bindings_data:
-            bindings_data[device_id] = []
+        device_bindings = bindings_data.setdefault(device_id, [])
         
         # Check if binding already exists
-        for binding in bindings_data[device_id]:
+        for binding in device_bindings:
             if binding["chat_id"] == chat_id and binding["platform"] == platform:
-                logger.info(f"Binding already exists for device {device_id}, chat_id {chat_id}, platform {platform}")
+                logger.info("Binding already exists for device %s, chat_id %s, platform %s", device_id, chat_id, platform)
                 return True
+        if len(device_bindings) >= MAX_BINDINGS_PER_DEVICE:
+            logger.warning("Device %s already has %s bindings, refusing chat_id %s", device_id, len(device_bindings), chat_id)
+            return False
         
-        bindings_data[device_id].append({"chat_id": chat_id, "platform": platform})
+        # load_bindings() copies only the outer dict, so build a new list instead of appending to the cached one
+        bindings_data[device_id] = device_bindings + [{"chat_id": chat_id, "platform": platform}]
         with config_lock:
             with open(file_path, 'w') as f:
                 json.dump(bindings_data, f, indent=4)
             global _bindings_last_modified, _cached_bindings
             _bindings_last_modified = os.path.getmtime(file_path)
             _cached_bindings = bindings_data
-        logger.info(f"Saved binding for device {device_id}, chat_id {chat_id}, platform {platform}")
+        logger.info("Saved binding for device %s, chat_id %s, platform %s", device_id, chat_id, platform)
         return True
     except Exception as e:
-        logger.error(f"Failed to save binding for device {device_id}, chat_id {chat_id}, platform {platform}: {e}")
+        logger.error("Failed to save binding for device %s, chat_id %s, platform %s: %s", device_id, chat_id, platform, e)
         return False
 
 def start_config_polling(file_path, interval=1):
@@ -217,12 +268,12 @@ def start_config_polling(file_path, interval=1):
                 load_device_config(file_path)
                 load_bindings(file_path=os.path.expanduser("~/Desktop/bindings.json"))
             except Exception as e:
-                logger.error(f"Error in config polling: {e}")
+                logger.error("Error in config polling: %s", e)
             time.sleep(interval)
     
     polling_thread = threading.Thread(target=poll_config, daemon=True)
     polling_thread.start()
-    logger.info(f"Started polling {file_path} every {interval} seconds")
+    logger.info("Started polling %s every %s seconds", file_path, interval)
 
 # Initialize configuration
 config_file_path = os.getenv('DEVICE_CONFIG_PATH', os.path.expanduser("~/Desktop/device_config.json"))
@@ -232,40 +283,112 @@ _cached_bindings = load_bindings()
 # Start polling in a separate thread
 start_config_polling(config_file_path)
 
+def env_int(name: str, default: int) -> int:
+    """Read an integer setting once at import, falling back to default on a malformed value."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        logger.error("Invalid integer for %s: %r. Using default %s.", name, value, default)
+        return default
+
+def env_float(name: str, default: float) -> float:
+    """Read a float setting once at import, falling back to default on a malformed value."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        logger.error("Invalid number for %s: %r. Using default %s.", name, value, default)
+        return default
+
+def env_flag(name: str, default: bool) -> bool:
+    """Read a true/false setting; anything other than 'false' counts as true."""
+    value = os.getenv(name)
+    return default if value is None else value.lower() != 'false'
+
 # LINE and Telegram API configurations
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN', 'YOUR_TELEGRAM_BOT_TOKEN')
 TELEGRAM_API_URL = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
+# Bot API messages per second Telegram lets one bot send, and seconds a /SendBatch caller waits
+TELEGRAM_SEND_RATE = max(1, env_int('TELEGRAM_SEND_RATE', 30))
+TELEGRAM_BATCH_TIMEOUT = env_int('TELEGRAM_BATCH_TIMEOUT', 30)
+# Maximum number of recipients per IMTelegram /SendBatch request; a larger batch could not be
+# sent within the caller's timeout at the bot's rate limit
+TELEGRAM_BATCH_SIZE = env_int('TELEGRAM_BATCH_SIZE', 100)
+if TELEGRAM_BATCH_SIZE > TELEGRAM_SEND_RATE * TELEGRAM_BATCH_TIMEOUT:
+    logger.error("TELEGRAM_BATCH_SIZE %s cannot be sent within %ss at %s messages/s. Using %s.",
+                 TELEGRAM_BATCH_SIZE, TELEGRAM_BATCH_TIMEOUT, TELEGRAM_SEND_RATE, TELEGRAM_SEND_RATE * TELEGRAM_BATCH_TIMEOUT)
+    TELEGRAM_BATCH_SIZE = TELEGRAM_SEND_RATE * TELEGRAM_BATCH_TIMEOUT
 
 LINE_API_URL = os.getenv('LINE_API_URL', 'https://api.line.me/v2/bot/message')
 LINE_ACCESS_TOKEN = os.getenv('LINE_ACCESS_TOKEN', 'YOUR_LINE_ACCESS_TOKEN')
 
 # IOTQueue (MQTT) and RabbitMQ configurations
 IOTQUEUE_HOST = os.getenv('IOTQUEUE_HOST', 'localhost')
-IOTQUEUE_PORT = int(os.getenv('IOTQUEUE_PORT', 1883))
+IOTQUEUE_PORT = env_int('IOTQUEUE_PORT', 1883)
 RABBITMQ_HOST = os.getenv('RABBITMQ_HOST', 'localhost')
-RABBITMQ_PORT = int(os.getenv('RABBITMQ_PORT', 5672))
+RABBITMQ_PORT = env_int('RABBITMQ_PORT', 5672)
 RABBITMQ_LINE_QUEUE = "IM_Line_Queue"
 RABBITMQ_TELEGRAM_QUEUE = "IM_Telegram_Queue"
+# Unacked deliveries the IM consumers let the broker push ahead, and how acks are batched
+RABBITMQ_PREFETCH = env_int('RABBITMQ_PREFETCH', 64)
+RABBITMQ_ACK_BATCH_SIZE = env_int('RABBITMQ_ACK_BATCH_SIZE', 32)
+RABBITMQ_ACK_FLUSH_INTERVAL = env_float('RABBITMQ_ACK_FLUSH_INTERVAL', 1.0)
+# Device services: commands prefetched ahead of the one being handled, and status updates held
+# while the broker is unreachable
+RABBITMQ_DEVICE_PREFETCH = env_int('RABBITMQ_DEVICE_PREFETCH', 8)
+RABBITMQ_STATUS_OUTBOX = env_int('RABBITMQ_STATUS_OUTBOX', 1024)
+# false = ack status updates as soon as they are handed to a worker (at-most-once delivery)
+RABBITMQ_WAIT_FOR_SEND = env_flag('RABBITMQ_WAIT_FOR_SEND', True)
+# Maximum number of messages committed per publisher transaction
+RABBITMQ_PUBLISH_BATCH_SIZE = env_int('RABBITMQ_PUBLISH_BATCH_SIZE', 100)
+# Commands buffered for the publisher thread, and how long in seconds a caller waits for room
+# before the command is dropped while the broker lags
+RABBITMQ_PUBLISH_BUFFER = env_int('RABBITMQ_PUBLISH_BUFFER', 10000)
+RABBITMQ_PUBLISH_TIMEOUT = env_float('RABBITMQ_PUBLISH_TIMEOUT', 1.0)
+# false = publish device commands as transient messages (no broker disk write, lost if the broker restarts)
+RABBITMQ_COMMAND_PERSISTENT = env_flag('RABBITMQ_COMMAND_PERSISTENT', True)
+# Per-device command queues drop commands older than this many seconds, and the oldest beyond this
+# many waiting, so queues of devices without a running service stay bounded
+RABBITMQ_COMMAND_TTL = env_int('RABBITMQ_COMMAND_TTL', 60)
+RABBITMQ_COMMAND_QUEUE_MAX = env_int('RABBITMQ_COMMAND_QUEUE_MAX', 100)
+# Heartbeat interval in seconds (a dead broker is noticed after about two missed beats)
+# and the ceiling in seconds for the reconnect backoff
+RABBITMQ_HEARTBEAT = env_int('RABBITMQ_HEARTBEAT', 30)
+RABBITMQ_RECONNECT_MAX = env_int('RABBITMQ_RECONNECT_MAX', 30)
+# Seconds during which a chat repeating its last command is published only once (0 disables)
+COMMAND_DEDUP_WINDOW = env_float('COMMAND_DEDUP_WINDOW', 0.2)
 DEVICE_ID = os.getenv('DEVICE_ID', 'esp32_light_001')
 
+# Optional Redis for chat/greeting state shared between worker processes (unset = process-local)
+REDIS_URL = os.getenv('REDIS_URL')
+
 # Flask API configurations
 TELEGRAM_API_HOST = os.getenv('TELEGRAM_API_HOST', 'localhost')
-TELEGRAM_API_PORT = int(os.getenv('TELEGRAM_API_PORT', 5000))
+TELEGRAM_API_PORT = env_int('TELEGRAM_API_PORT', 5000)
 LINE_API_HOST = os.getenv('LINE_API_HOST', 'localhost')
-LINE_API_PORT = int(os.getenv('LINE_API_PORT', 5001))
+LINE_API_PORT = env_int('LINE_API_PORT', 5001)
 ESP32_API_HOST = os.getenv('ESP32_API_HOST', 'localhost')
-ESP32_API_PORT = int(os.getenv("ESP32_API_PORT", 5002))
+ESP32_API_PORT = env_int('ESP32_API_PORT', 5002)
 RASPBERRY_PI_API_HOST = os.getenv('RASPBERRY_PI_API_HOST', 'localhost')
-RASPBERRY_PI_API_PORT = int(os.getenv("RASPBERRY_PI_API_PORT", 5003))
+RASPBERRY_PI_API_PORT = env_int('RASPBERRY_PI_API_PORT', 5003)
 
 # Device types and platforms
 DEVICE_TYPES = ['light', 'fan']
 PLATFORMS = ['esp_32', 'pi']
 
-# Supported device IDs
-SUPPORTED_DEVICES = [
+# Supported device IDs; a frozenset for membership checks, plus the joined list shown to users
+SUPPORTED_DEVICES_LIST = (
     "esp32_light_001",
     "esp32_fan_002",
     "raspberrypi_light_001",
     "raspberrypi_fan_002"
-]
\ No newline at end of file
+)
+SUPPORTED_DEVICES = frozenset(SUPPORTED_DEVICES_LIST)
+SUPPORTED_DEVICES_STR = ", ".join(SUPPORTED_DEVICES_LIST)
+# Upper bound on bindings per device so spammed /bind commands cannot grow bindings.json without limit
+MAX_BINDINGS_PER_DEVICE = env_int('MAX_BINDINGS_PER_DEVICE', 10000)
\ No newline at end of file
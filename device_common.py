@@ -0,0 +1,408 @@
+# device_common.py
+# Command signing, the device HTTP session, the RabbitMQ command consumer and the API proxy routes
+# shared by the real device services (esp32_iot_device.py, raspberrypi_iot_device.py)
+import logging
+import os
+import time
+import base64
+import threading
+import functools
+from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from flask import request
+import pika
+import config
+import broker
+from flask_common import json_response, relay_response, request_json
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
+
+try:
+    from Crypto.Signature import DSS
+    from Crypto.Hash import SHA256
+    from Crypto.PublicKey import ECC
+except ImportError:
+    DSS = None
+    SHA256 = None
+    ECC = None
+    logging.warning("pycryptodome not installed, signature generation disabled")
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Keep-alive session for every call to the device HTTP API, so commands skip the TCP handshake
+http_session = requests.Session()
+_http_adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64)
+http_session.mount("https://", _http_adapter)
+http_session.mount("http://", _http_adapter)
+# (connect, read) seconds: an unreachable device fails in 2s instead of holding a handler for 5s
+DEVICE_API_TIMEOUT = (2, 5)
+private_key = None
+# Built once with the key; a DSS signer keeps no per-signature state, so it is reused for every command
+signer = None
+
+def load_private_key():
+    global private_key, signer
+    if ECC is None:
+        logger.error("pycryptodome not available, cannot load private key")
+        return False
+    try:
+        if not os.path.exists("ecdsa_private.pem"):
+            logger.error("Private key file 'ecdsa_private.pem' not found")
+            return False
+        with open("ecdsa_private.pem", "rt") as f:
+            private_key = ECC.import_key(f.read())
+        signer = DSS.new(private_key, 'fips-186-3')
+        sign_timestamp.cache_clear()
+        logger.info("Private key loaded successfully")
+        return True
+    except Exception as e:
+        logger.error("Failed to load private key: %s", e)
+        return False
+
+# Keyed by the second, so commands for one chat within the same second share a single ECDSA sign;
+# stale seconds simply age out of the LRU
+@lru_cache(maxsize=1024)
+def sign_timestamp(chat_id: str, timestamp: str) -> str:
+    h = SHA256.new(f"{chat_id}:{timestamp}".encode('utf-8'))
+    return base64.b64encode(signer.sign(h)).decode('utf-8')
+
+def generate_signature(chat_id: str):
+    if signer is None or SHA256 is None:
+        logger.error("No private key or pycryptodome not available")
+        return {"success": False, "error": "No private key or pycryptodome not available"}
+    
+    try:
+        timestamp = str(int(time.time()))
+        signature_b64 = sign_timestamp(chat_id, timestamp)
+        result = {
+            "success": True,
+            "chat_id": chat_id,
+            "timestamp": timestamp,
+            "signature": signature_b64,
+            "username": "",
+            "bot_token": ""
+        }
+        logger.info("Generated signature for chat_id: %s", chat_id)
+        return result
+    except Exception as e:
+        logger.error("Error generating signature: %s", e)
+        return {"success": False, "error": str(e)}
+
+# Commands the broker may push ahead while the previous one is still being handled
+COMMAND_PREFETCH = config.RABBITMQ_DEVICE_PREFETCH
+# Status updates held while the broker is unreachable; newer ones are dropped beyond this
+STATUS_OUTBOX_SIZE = config.RABBITMQ_STATUS_OUTBOX
+
+SIGNATURE_RECEIVED_RESPONSE = json_response({"status": "received"}, 200)
+
+class IoTDevice(ABC):
+    """
+    A device reached through its HTTP API and commanded over RabbitMQ.
+    Subclasses set the manufacturer, where the device API lives and how it is called.
+    """
+    # Command queue name prefix; see broker.command_queue
+    manufacturer = None
+    # Key of the API base URL in the device config, and the path segment after it
+    config_key = None
+    path_prefix = None
+
+    def __init__(self, name: str, device_id: str):
+        self.name = name
+        self.device_id = device_id
+        self.device_type = "light" if "light" in device_id else "fan"
+        self.rabbitmq_connection = None
+        self.rabbitmq_channel = None
+        self.rabbitmq_consumer_thread = None
+        self.running = False
+        # Set by stop(); reconnect backoff waits on it so shutdown does not sit out a full delay
+        self.stop_requested = threading.Event()
+        # Command -> handler, built once instead of an if/elif chain per message
+        self.command_handlers = {
+            "on": self.handle_enable,
+            "off": self.handle_disable,
+            "get_status": self.handle_get_status
+        }
+        # Commands run here, one at a time and in arrival order, so the consumer thread keeps
+        # reading and servicing heartbeats while a device HTTP call is in flight
+        self.handler_pool = ThreadPoolExecutor(max_workers=1)
+        # (queue_name, body, status) waiting for the consumer thread to publish; see flush_status
+        self.status_outbox = deque()
+        # (device config the URLs were built from, action -> URL); see api_urls
+        self.cached_urls = (None, {})
+        self.invalid_device_response = json_response(
+            {"status": "error", "message": f"Invalid device ID, expected {device_id}"}, 400)
+
+    @abstractmethod
+    def send_request(self, url: str, data: dict, method: str = "POST") -> requests.Response:
+        """Call the device API at url with data; method is that of the proxied request, if any."""
+
+    def api_urls(self) -> dict:
+        # Device API URLs, rebuilt only when the polled device config is replaced
+        device_config = config.get_device_config()
+        source, urls = self.cached_urls
+        if source is not device_config:
+            base = f"{device_config[self.config_key]['url']}/{self.path_prefix}/{self.device_id}"
+            urls = {action: f"{base}/{action}" for action in ("Enable", "Disable", "GetStatus")}
+            self.cached_urls = (device_config, urls)
+        return urls
+
+    def setup_rabbitmq_connection(self):
+        # Setup RabbitMQ connection
+        try:
+            self.rabbitmq_connection, self.rabbitmq_channel = broker.connect()
+            logger.info("RabbitMQ BlockingConnection established successfully")
+            return True
+        except Exception as e:
+            logger.error("Failed to establish RabbitMQ BlockingConnection: %s", e)
+            return False
+
+    def on_rabbitmq_message(self, channel, method, properties, body):
+        # Process RabbitMQ message
+        try:
+            payload = json_loads(body)
+        except ValueError as e:
+            logger.error("Invalid JSON in RabbitMQ message: %s", e)
+            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        logger.info("Received RabbitMQ message: %s", payload)
+
+        command = payload.get("command")
+        handler = self.command_handlers.get(command)
+        if handler is None:
+            logger.warning("Ignoring unknown command: %s", command)
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            return
+        self.handler_pool.submit(self.run_handler, handler, payload, self.rabbitmq_connection, channel, method.delivery_tag)
+
+    def run_handler(self, handler, payload, connection, channel, delivery_tag):
+        # Runs on handler_pool; the ack/nack is handed back to the connection's thread
+        ok = True
+        try:
+            handler(payload)
+        except Exception as e:
+            logger.error("Error processing RabbitMQ message: %s", e)
+            ok = False
+        if ok:
+            settle = functools.partial(channel.basic_ack, delivery_tag=delivery_tag)
+        else:
+            settle = functools.partial(channel.basic_nack, delivery_tag=delivery_tag, requeue=False)
+        try:
+            connection.add_callback_threadsafe(settle)
+        except Exception as e:
+            logger.warning("Could not settle delivery %s, broker will redeliver it: %s", delivery_tag, e)
+
+    def consume_messages(self):
+        # Consume messages from RabbitMQ queue, backing off exponentially while the broker is down
+        backoff = 1
+        while self.running:
+            try:
+                if not self.rabbitmq_connection or self.rabbitmq_connection.is_closed:
+                    logger.info("RabbitMQ connection closed, reconnecting...")
+                    if not self.setup_rabbitmq_connection():
+                        self.stop_requested.wait(backoff)
+                        backoff = min(broker.RECONNECT_MAX_BACKOFF, backoff * 2)
+                        continue
+
+                queue_name = broker.command_queue(self.manufacturer, self.device_id)
+                broker.declare_command_queue(self.rabbitmq_channel, queue_name)
+                # Declare the status queues once per channel so flush_status only publishes
+                for status_queue in broker.STATUS_QUEUES.values():
+                    self.rabbitmq_channel.queue_declare(queue=status_queue, durable=True)
+                self.rabbitmq_channel.basic_qos(prefetch_count=COMMAND_PREFETCH)
+                # Send status updates that piled up while the connection was down
+                self.flush_status()
+
+                logger.info("Starting to consume messages from %s", queue_name)
+
+                for method, properties, body in self.rabbitmq_channel.consume(
+                    queue_name, inactivity_timeout=1, auto_ack=False):
+
+                    if not self.running:
+                        break
+
+                    if method is None:
+                        continue
+
+                    backoff = 1
+                    self.on_rabbitmq_message(self.rabbitmq_channel, method, properties, body)
+
+            except (pika.exceptions.ConnectionClosed,
+                   pika.exceptions.ChannelClosed,
+                   pika.exceptions.StreamLostError) as e:
+                logger.error("RabbitMQ connection error: %s, reconnecting in %ss...", e, backoff)
+                self.stop_requested.wait(backoff)
+                backoff = min(broker.RECONNECT_MAX_BACKOFF, backoff * 2)
+            except Exception as e:
+                logger.error("Unexpected error in consume_messages: %s", e)
+                self.stop_requested.wait(backoff)
+                backoff = min(broker.RECONNECT_MAX_BACKOFF, backoff * 2)
+
+    def start_rabbitmq(self):
+        # Start RabbitMQ consumer thread
+        self.running = True
+        self.rabbitmq_consumer_thread = threading.Thread(target=self.consume_messages)
+        self.rabbitmq_consumer_thread.daemon = True
+        self.rabbitmq_consumer_thread.start()
+        logger.info("RabbitMQ consumer started for %s", self.device_id)
+
+    def notify_status(self, status: str, chat_id: str, platform: str, username: str, bot_token: str):
+        # Send status notification to IM system
+        queue_name = broker.STATUS_QUEUES.get(platform)
+        if queue_name is None:
+            logger.error("Unsupported platform: %s", platform)
+            return
+
+        message = {
+            "device_status": status,
+            "device_id": self.device_id,
+            "chat_id": chat_id,
+            "platform": platform,
+            "username": username,
+            "bot_token": bot_token
+        }
+
+        if len(self.status_outbox) >= STATUS_OUTBOX_SIZE:
+            logger.error("Status outbox is full, dropping %s update for %s", status, queue_name)
+            return
+        self.status_outbox.append((queue_name, json_dumps(message), status))
+        # Called from handler_pool; pika connections are not thread-safe, so the consumer thread publishes
+        try:
+            self.rabbitmq_connection.add_callback_threadsafe(self.flush_status)
+        except Exception as e:
+            # The consumer thread flushes the outbox again once it has reconnected
+            logger.warning("Status update for %s queued until RabbitMQ reconnects: %s", queue_name, e)
+
+    def flush_status(self):
+        # Runs on the consumer thread; publishes every queued status update in one pass
+        while self.status_outbox:
+            queue_name, body, status = self.status_outbox.popleft()
+            try:
+                self.rabbitmq_channel.basic_publish(
+                    exchange='',
+                    routing_key=queue_name,
+                    body=body,
+                    properties=broker.STATUS_UPDATE_PROPERTIES
+                )
+            except pika.exceptions.AMQPError as e:
+                # Keep it at the head of the outbox for the next connection
+                self.status_outbox.appendleft((queue_name, body, status))
+                logger.error("Failed to publish status update to %s: %s", queue_name, e)
+                return
+            logger.info("Status update sent to %s for device_id: %s, status: %s", queue_name, self.device_id, status)
+
+    def handle_enable(self, payload):
+        self.call_device_api(payload, "Enable", "on")
+
+    def handle_disable(self, payload):
+        self.call_device_api(payload, "Disable", "off")
+
+    def handle_get_status(self, payload):
+        self.call_device_api(payload, "GetStatus")
+
+    def call_device_api(self, payload, action: str, status: str = None):
+        # Send a signed command to the device and report the resulting status; without a fixed
+        # status, the device's reported state is used
+        chat_id = payload.get("chat_id")
+        platform = payload.get("platform", "telegram")
+        username = payload.get("username", "User")
+        bot_token = payload.get("bot_token", "")
+        device_id = payload.get("device_id")
+
+        if device_id != self.device_id:
+            logger.error("Invalid device_id in payload: %s, expected %s", device_id, self.device_id)
+            return
+
+        try:
+            signature = generate_signature(chat_id)
+            if not signature["success"]:
+                logger.error("Signature generation failed: %s", signature['error'])
+                return
+
+            url = self.api_urls()[action]
+            data = {
+                "device_id": self.device_id,
+                "chat_id": chat_id,
+                "timestamp": signature["timestamp"],
+                "signature": signature["signature"],
+                "username": username,
+                "bot_token": bot_token
+            }
+
+            logger.info("Sending %s request to %s", action, url)
+            response = self.send_request(url, data)
+
+            if response.status_code == 200:
+                if status is None:
+                    status = self.reported_state(response)
+                logger.info("%s request succeeded for device_id: %s, status: %s", action, self.device_id, status)
+                self.notify_status(status, chat_id, platform, username, bot_token)
+            else:
+                logger.error("%s request failed: %s - %s", action, response.status_code, response.text)
+        except (requests.RequestException, ValueError) as e:
+            logger.error("Error calling %s API: %s", action, e)
+
+    def reported_state(self, response) -> str:
+        # A device answering with something other than a JSON object (an HTML error page, say)
+        # still gets a status reply to the user rather than a nacked command
+        try:
+            body = json_loads(response.content)
+        except ValueError:
+            logger.error("Device %s returned a non-JSON status: %s", self.device_id, response.text)
+            return "unknown"
+        return body.get("state", "unknown") if isinstance(body, dict) else "unknown"
+
+    def proxy_api(self, device_id: str, action: str):
+        # API Proxy: Forward request to actual device
+        if not device_id or device_id != self.device_id:
+            logger.error("Invalid device ID: %s, expected %s", device_id, self.device_id)
+            return self.invalid_device_response
+
+        # Note: Keep parsing POST JSON here as this endpoint might be called by other microservices
+        data = request_json() if request.method == 'POST' else request.args
+        params = {
+            "device_id": device_id,
+            "chat_id": data.get('chat_id', "default"),
+            "timestamp": data.get('timestamp'),
+            "signature": data.get('signature'),
+            "username": data.get('username', "User"),
+            "bot_token": data.get('bot_token', "")
+        }
+
+        try:
+            url = self.api_urls()[action]
+            logger.info("Sending %s API request to %s", action, url)
+            return relay_response(self.send_request(url, params, request.method))
+        except requests.RequestException as e:
+            logger.error("Error in %s API: %s", action, e)
+            return json_response({"status": "error", "message": str(e)}, 500)
+
+    def stop(self):
+        # Stop RabbitMQ consumer
+        self.running = False
+        self.stop_requested.set()
+        self.handler_pool.shutdown(wait=False)
+        try:
+            if self.rabbitmq_connection and not self.rabbitmq_connection.is_closed:
+                self.rabbitmq_connection.close()
+            logger.info("RabbitMQ connection closed")
+        except Exception as e:
+            logger.error("Error stopping RabbitMQ: %s", e)
+
+def register_device_routes(app, device: IoTDevice):
+    """Add the device API proxy routes and the signature endpoint for device to app."""
+    for action, endpoint in (("Enable", "api_enable"), ("Disable", "api_disable"), ("GetStatus", "api_get_status")):
+        app.add_url_rule(f"/{device.path_prefix}/<device_id>/{action}", endpoint=endpoint,
+                         view_func=functools.partial(device.proxy_api, action=action), methods=['GET', 'POST'])
+
+    @app.route('/signature', methods=['POST'])
+    def api_signature():
+        data = request.get_json()
+        logger.info("Received signature request")
+        return SIGNATURE_RECEIVED_RESPONSE
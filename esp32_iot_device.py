@@ -1,25 +1,12 @@
 # esp32_iot_device.py
-from flask import Flask, request, send_from_directory, jsonify
+from flask import send_from_directory
+from flask_common import create_app
 from flask_swagger_ui import get_swaggerui_blueprint
-import pika
-import json
 import config
 import logging
-import threading
-import time
 import os
-import base64
-
-try:
-    from Crypto.Signature import DSS
-    from Crypto.Hash import SHA256
-    from Crypto.PublicKey import ECC
-except ImportError:
-    DSS = None
-    SHA256 = None
-    ECC = None
-    logging.warning("pycryptodome not installed, signature generation disabled")
 import requests
+from device_common import http_session, DEVICE_API_TIMEOUT, load_private_key, IoTDevice, register_device_routes
 
 logging.basicConfig(
     level=logging.INFO,
@@ -30,478 +17,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-private_key = None
-
-def load_private_key():
-    global private_key
-    if ECC is None:
-        logger.error("pycryptodome not available, cannot load private key")
-        return False
-    try:
-        if not os.path.exists("ecdsa_private.pem"):
-            logger.error("Private key file 'ecdsa_private.pem' not found")
-            return False
-        with open("ecdsa_private.pem", "rt") as f:
-            private_key = ECC.import_key(f.read())
-        logger.info("Private key loaded successfully")
-        return True
-    except Exception as e:
-        logger.error(f"Failed to load private key: {e}")
-        return False
-
-def generate_signature(chat_id: str):
-    if not private_key or DSS is None or SHA256 is None:
-        logger.error("No private key or pycryptodome not available")
-        return {"success": False, "error": "No private key or pycryptodome not available"}
-    
-    try:
-        timestamp = str(int(time.time()))
-        message = f"{chat_id}:{timestamp}".encode('utf-8')
-        h = SHA256.new(message)
-        signer = DSS.new(private_key, 'fips-186-3')
-        signature = signer.sign(h)
-        signature_b64 = base64.b64encode(signature).decode('utf-8')
-        result = {
-            "success": True,
-            "chat_id": chat_id,
-            "timestamp": timestamp,
-            "signature": signature_b64,
-            "username": "",
-            "bot_token": ""
-        }
-        logger.info(f"Generated signature for chat_id: {chat_id}")
-        return result
-    except Exception as e:
-        logger.error(f"Error generating signature: {e}")
-        return {"success": False, "error": str(e)}
-
-class ESP32Device:
-    def __init__(self, name: str, device_id: str):
-        self.name = name
-        self.device_id = device_id
-        self.manufacturer = "esp32"
-        self.device_type = "light" if "light" in device_id else "fan"
-        self.rabbitmq_connection = None
-        self.rabbitmq_channel = None
-        self.rabbitmq_consumer_thread = None
-        self.running = False
-        self.start_rabbitmq()
-
-    def setup_rabbitmq_connection(self):
-        # Setup RabbitMQ connection
-        try:
-            parameters = pika.ConnectionParameters(
-                host=config.RABBITMQ_HOST,
-                port=config.RABBITMQ_PORT,
-                heartbeat=30,
-                blocked_connection_timeout=60
-            )
-            self.rabbitmq_connection = pika.BlockingConnection(parameters)
-            self.rabbitmq_channel = self.rabbitmq_connection.channel()
-            logger.info("RabbitMQ BlockingConnection established successfully")
-            return True
-        except Exception as e:
-            logger.error(f"Failed to establish RabbitMQ BlockingConnection: {e}")
-            return False
-
-    def on_rabbitmq_message(self, channel, method, properties, body):
-        # Process RabbitMQ message
-        try:
-            payload = json.loads(body.decode('utf-8'))
-            logger.info(f"Received RabbitMQ message: {payload}")
-            
-            command = payload.get("command")
-            if command == "on":
-                self.handle_enable(payload)
-            elif command == "off":
-                self.handle_disable(payload)
-            elif command == "get_status":
-                self.handle_get_status(payload)
-                
-            channel.basic_ack(delivery_tag=method.delivery_tag)
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON in RabbitMQ message: {e}")
-            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-        except Exception as e:
-            logger.error(f"Error processing RabbitMQ message: {e}")
-            channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-
-    def consume_messages(self):
-        # Consume messages from RabbitMQ queue
-        while self.running:
-            try:
-                if not self.rabbitmq_connection or self.rabbitmq_connection.is_closed:
-                    logger.info("RabbitMQ connection closed, reconnecting...")
-                    if not self.setup_rabbitmq_connection():
-                        time.sleep(5)
-                        continue
-
-                queue_name = "iot_esp32_queue"
-                self.rabbitmq_channel.queue_declare(queue=queue_name, durable=True)
-                self.rabbitmq_channel.basic_qos(prefetch_count=1)
-                
-                logger.info(f"Starting to consume messages from {queue_name}")
-                
-                for method, properties, body in self.rabbitmq_channel.consume(
-                    queue_name, inactivity_timeout=1, auto_ack=False):
-                    
-                    if not self.running:
-                        break
-                        
-                    if method is None:
-                        continue
-                        
-                    self.on_rabbitmq_message(self.rabbitmq_channel, method, properties, body)
-                        
-            except (pika.exceptions.ConnectionClosed, 
-                   pika.exceptions.ChannelClosed,
-                   pika.exceptions.StreamLostError) as e:
-                logger.error(f"RabbitMQ connection error: {e}, reconnecting...")
-                time.sleep(5)
-            except Exception as e:
-                logger.error(f"Unexpected error in consume_messages: {e}")
-                time.sleep(5)
+app = create_app(__name__)
 
-    def start_rabbitmq(self):
-        # Start RabbitMQ consumer thread
-        self.running = True
-        self.rabbitmq_consumer_thread = threading.Thread(target=self.consume_messages)
-        self.rabbitmq_consumer_thread.daemon = True
-        self.rabbitmq_consumer_thread.start()
-        logger.info(f"RabbitMQ consumer started for {self.device_id}")
+class ESP32Device(IoTDevice):
+    manufacturer = "esp32"
+    config_key = "esp32"
+    path_prefix = "ESP32"
 
-    def notify_status(self, status: str, chat_id: str, platform: str, username: str, bot_token: str):
-        # Send status notification to IM system
-        message = {
-            "device_status": status,
-            "device_id": self.device_id,
-            "chat_id": chat_id,
-            "platform": platform,
-            "username": username,
-            "bot_token": bot_token
-        }
-        
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                if not self.rabbitmq_connection or self.rabbitmq_connection.is_closed:
-                    logger.info(f"RabbitMQ connection closed, reconnecting (attempt {attempt + 1}/{max_retries})...")
-                    if not self.setup_rabbitmq_connection():
-                        time.sleep(2)
-                        continue
-                
-                if platform == "line":
-                    queue_name = config.RABBITMQ_LINE_QUEUE
-                elif platform == "telegram":
-                    queue_name = config.RABBITMQ_TELEGRAM_QUEUE
-                else:
-                    logger.error(f"Unsupported platform: {platform}")
-                    return
-                
-                self.rabbitmq_channel.queue_declare(queue=queue_name, durable=True)
-                self.rabbitmq_channel.basic_publish(
-                    exchange='',
-                    routing_key=queue_name,
-                    body=json.dumps(message),
-                    properties=pika.BasicProperties(
-                        delivery_mode=2,
-                    )
-                )
-                logger.info(f"Status update sent to {queue_name} for device_id: {self.device_id}, status: {status}")
-                break
-            except (pika.exceptions.StreamLostError, pika.exceptions.ConnectionClosed, 
-                    pika.exceptions.ChannelClosed, pika.exceptions.ChannelClosedByBroker, 
-                    ConnectionResetError, requests.RequestException) as e:
-                logger.error(f"Failed to send status update (attempt {attempt + 1}/{max_retries}): {e}")
-                if attempt < max_retries - 1:
-                    time.sleep(2)
-                else:
-                    logger.error("Max retries reached, giving up")
-
-    def handle_enable(self, payload):
-        chat_id = payload.get("chat_id")
-        platform = payload.get("platform", "telegram")
-        username = payload.get("username", "User")
-        bot_token = payload.get("bot_token", "")
-        device_id = payload.get("device_id")
-        
-        if device_id != self.device_id:
-            logger.error(f"Invalid device_id in payload: {device_id}, expected {self.device_id}")
-            return
-        
-        try:
-            signature = generate_signature(chat_id)
-            if not signature["success"]:
-                logger.error(f"Signature generation failed: {signature['error']}")
-                return
-            
-            device_config = config.load_device_config()
-            url = f"{device_config['esp32']['url']}/ESP32/{device_id}/Enable"
-            
-            # Convert to GET request and use params to pass data
-            data = {
-                "device_id": self.device_id,
-                "chat_id": chat_id,
-                "timestamp": signature["timestamp"],
-                "signature": signature["signature"],
-                "username": username,
-                "bot_token": bot_token
-            }
-            
-            logger.info(f"Sending enable GET request to {url}")
-            response = requests.get(
-                url,
-                params=data, # Use params to pass data as URL query string
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                logger.info(f"Enable request succeeded for device_id: {self.device_id}")
-                self.notify_status("on", chat_id, platform, username, bot_token)
-            else:
-                logger.error(f"Enable request failed: {response.status_code} - {response.text}")
-        except requests.RequestException as e:
-            logger.error(f"Error calling enable API: {e}")
-
-    def handle_disable(self, payload):
-        chat_id = payload.get("chat_id")
-        platform = payload.get("platform", "telegram")
-        username = payload.get("username", "User")
-        bot_token = payload.get("bot_token", "")
-        device_id = payload.get("device_id")
-        
-        if device_id != self.device_id:
-            logger.error(f"Invalid device_id in payload: {device_id}, expected {self.device_id}")
-            return
-        
-        try:
-            signature = generate_signature(chat_id)
-            if not signature["success"]:
-                logger.error(f"Signature generation failed: {signature['error']}")
-                return
-            
-            device_config = config.load_device_config()
-            url = f"{device_config['esp32']['url']}/ESP32/{device_id}/Disable"
-            
-            # Convert to GET request and use params to pass data
-            data = {
-                "device_id": self.device_id,
-                "chat_id": chat_id,
-                "timestamp": signature["timestamp"],
-                "signature": signature["signature"],
-                "username": username,
-                "bot_token": bot_token
-            }
-            
-            logger.info(f"Sending disable GET request to {url}")
-            response = requests.get(
-                url,
-                params=data, # Use params to pass data as URL query string
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                logger.info(f"Disable request succeeded for device_id: {self.device_id}")
-                self.notify_status("off", chat_id, platform, username, bot_token)
-            else:
-                logger.error(f"Disable request failed: {response.status_code} - {response.text}")
-        except requests.RequestException as e:
-            logger.error(f"Error calling disable API: {e}")
-
-    def handle_get_status(self, payload):
-        chat_id = payload.get("chat_id")
-        platform = payload.get("platform", "telegram")
-        username = payload.get("username", "User")
-        bot_token = payload.get("bot_token", "")
-        device_id = payload.get("device_id")
-        
-        if device_id != self.device_id:
-            logger.error(f"Invalid device_id in payload: {device_id}, expected {self.device_id}")
-            return
-        
-        try:
-            signature = generate_signature(chat_id)
-            if not signature["success"]:
-                logger.error(f"Signature generation failed: {signature['error']}")
-                return
-            
-            device_config = config.load_device_config()
-            url = f"{device_config['esp32']['url']}/ESP32/{device_id}/GetStatus"
-            
-            # Convert to GET request and use params to pass data
-            data = {
-                "device_id": self.device_id,
-                "chat_id": chat_id,
-                "timestamp": signature["timestamp"],
-                "signature": signature["signature"],
-                "username": username,
-                "bot_token": bot_token
-            }
-            
-            logger.info(f"Sending get_status GET request to {url}")
-            response = requests.get(
-                url,
-                params=data, # Use params to pass data as URL query string
-                timeout=5
-            )
-            
-            if response.status_code == 200:
-                status = response.json().get("state", "unknown")
-                logger.info(f"GetStatus request succeeded: {status}")
-                self.notify_status(status, chat_id, platform, username, bot_token)
-            else:
-                logger.error(f"GetStatus request failed: {response.status_code} - {response.text}")
-        except requests.RequestException as e:
-            logger.error(f"Error calling GetStatus API: {e}")
-
-    def stop(self):
-        # Stop RabbitMQ consumer
-        self.running = False
-        try:
-            if self.rabbitmq_connection and not self.rabbitmq_connection.is_closed:
-                self.rabbitmq_connection.close()
-            logger.info("RabbitMQ connection closed")
-        except Exception as e:
-            logger.error(f"Error stopping RabbitMQ: {e}")
+    def send_request(self, url: str, data: dict, method: str = "POST") -> requests.Response:
+        # The device only accepts GET, so commands and proxied POSTs alike go in the URL query string
+        return http_session.get(url, params=data, timeout=DEVICE_API_TIMEOUT)
 
 esp32_device = ESP32Device("LivingRoomLight", config.DEVICE_ID)
-
-@app.route('/ESP32/<device_id>/Enable', methods=['GET', 'POST'])
-def api_enable(device_id):
-    # API Proxy: Forward request to actual device
-    if not device_id or device_id != esp32_device.device_id:
-        logger.error(f"Invalid device ID: {device_id}")
-        return jsonify({"status": "error", "message": "Invalid device ID"}), 400
-    
-    if request.method == 'POST':
-        # Note: Keep parsing POST JSON here as this endpoint might be called by other microservices
-        data = request.get_json(silent=True) or {}
-        chat_id = data.get('chat_id', "default")
-        timestamp = data.get('timestamp')
-        signature_b64 = data.get('signature')
-        username = data.get('username', "User")
-        bot_token = data.get('bot_token', "")
-        
-        # Since the device only accepts GET now, we need to convert POST data to GET params
-        params = data
-        request_func = requests.get
-        
-    else: # GET request
-        params = request.args
-        chat_id = params.get('chat_id', "default")
-        timestamp = params.get('timestamp')
-        signature_b64 = params.get('signature')
-        username = params.get('username', "User")
-        bot_token = params.get('bot_token', "")
-        request_func = requests.get
-    
-    try:
-        device_config = config.load_device_config()
-        url = f"{device_config['esp32']['url']}/ESP32/{device_id}/Enable"
-        logger.info(f"Sending enable API request (GET) to {url}")
-        
-        response = request_func(
-            url,
-            params=params, # Pass all query string parameters using params
-            timeout=5
-        )
-            
-        return jsonify(response.json()), response.status_code
-    except requests.RequestException as e:
-        logger.error(f"Error in enable API: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-@app.route('/ESP32/<device_id>/Disable', methods=['GET', 'POST'])
-def api_disable(device_id):
-    # API Proxy: Forward request to actual device
-    if not device_id or device_id != esp32_device.device_id:
-        logger.error(f"Invalid device ID: {device_id}")
-        return jsonify({"status": "error", "message": "Invalid device ID"}), 400
-    
-    if request.method == 'POST':
-        data = request.get_json(silent=True) or {}
-        chat_id = data.get('chat_id', "default")
-        timestamp = data.get('timestamp')
-        signature_b64 = data.get('signature')
-        username = data.get('username', "User")
-        bot_token = data.get('bot_token', "")
-        
-        params = data
-        request_func = requests.get
-        
-    else: # GET request
-        params = request.args
-        chat_id = params.get('chat_id', "default")
-        timestamp = params.get('timestamp')
-        signature_b64 = params.get('signature')
-        username = params.get('username', "User")
-        bot_token = params.get('bot_token', "")
-        request_func = requests.get
-    
-    try:
-        device_config = config.load_device_config()
-        url = f"{device_config['esp32']['url']}/ESP32/{device_id}/Disable"
-        logger.info(f"Sending disable API request (GET) to {url}")
-        
-        response = request_func(
-            url,
-            params=params,
-            timeout=5
-        )
-            
-        return jsonify(response.json()), response.status_code
-    except requests.RequestException as e:
-        logger.error(f"Error in disable API: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-@app.route('/ESP32/<device_id>/GetStatus', methods=['GET', 'POST'])
-def api_get_status(device_id):
-    # API Proxy: Forward request to actual device
-    if not device_id or device_id != esp32_device.device_id:
-        logger.error(f"Invalid device ID: {device_id}")
-        return jsonify({"status": "error", "message": "Invalid device ID"}), 400
-    
-    if request.method == 'POST':
-        data = request.get_json(silent=True) or {}
-        chat_id = data.get('chat_id', "default")
-        timestamp = data.get('timestamp')
-        signature_b64 = data.get('signature')
-        username = data.get('username', "User")
-        bot_token = data.get('bot_token', "")
-        
-        params = data
-        request_func = requests.get
-    else: # GET request
-        params = request.args
-        chat_id = params.get('chat_id', "default")
-        timestamp = params.get('timestamp')
-        signature_b64 = params.get('signature')
-        username = params.get('username', "User")
-        bot_token = params.get('bot_token', "")
-        request_func = requests.get
-    
-    try:
-        device_config = config.load_device_config()
-        url = f"{device_config['esp32']['url']}/ESP32/{device_id}/GetStatus"
-        logger.info(f"Sending get_status API request (GET) to {url}")
-        
-        response = request_func(
-            url,
-            params=params,
-            timeout=5
-        )
-            
-        return jsonify(response.json()), response.status_code
-    except requests.RequestException as e:
-        logger.error(f"Error in get_status API: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
-
-@app.route('/signature', methods=['POST'])
-def api_signature():
-    data = request.get_json()
-    logger.info(f"Received signature request")
-    return jsonify({"status": "received"}), 200
+register_device_routes(app, esp32_device)
 
 SWAGGER_URL = '/swagger'
 API_URL = '/static/openapi.yaml'
@@ -516,16 +44,24 @@ app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
 def serve_swagger(path):
     return send_from_directory('static', path)
 
+def init_service():
+    """Load the command signing key, create the static directory and start consuming commands; run once per worker."""
+    load_private_key()
+    if not os.path.exists('static'):
+        os.makedirs('static')
+    # Started here rather than at import so the consumer thread lives in the worker, not a preloading master
+    esp32_device.start_rabbitmq()
+
+# Development entry point; in production serve with
+#   GUNICORN_WORKERS=1 gunicorn -c gunicorn.conf.py -b 0.0.0.0:${ESP32_API_PORT} esp32_iot_device:app
 if __name__ == "__main__":
     try:
-        load_private_key()
-        if not os.path.exists('static'):
-            os.makedirs('static')
-        logger.info(f"Starting Flask app on port {config.ESP32_API_PORT}")
-        app.run(host="0.0.0.0", port=config.ESP32_API_PORT, debug=False)
+        init_service()
+        logger.info("Starting Flask app on port %s", config.ESP32_API_PORT)
+        app.run(host="0.0.0.0", port=config.ESP32_API_PORT, debug=False, threaded=True)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     except Exception as e:
-        logger.error(f"Fatal error: {e}")
+        logger.error("Fatal error: %s", e)
     finally:
         esp32_device.stop()
\ No newline at end of file
@@ -1,5 +1,6 @@
 # esp32_virtual_device.py
-from flask import Flask, request, jsonify
+from flask import request, jsonify
+from flask_common import create_app, json_response
 import logging
 import time
 import base64
@@ -18,11 +19,20 @@ import config
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
+app = create_app(__name__)
 
-devices = [{"device_id": config.DEVICE_ID, "state": "off"}]
+# device_id -> device state
+devices = {config.DEVICE_ID: {"device_id": config.DEVICE_ID, "state": "off"}}
 public_key = None
 
+MISSING_JSON_RESPONSE = json_response({"status": "error", "message": "Missing JSON data"}, 400)
+MISSING_FIELDS_RESPONSE = json_response({"status": "error", "message": "Missing fields"}, 400)
+SIGNATURE_VALID_RESPONSE = json_response({"status": "success", "message": "Signature valid"}, 200)
+INVALID_SIGNATURE_RESPONSE = json_response({"status": "error", "message": "Invalid signature"}, 403)
+EXPIRED_SIGNATURE_RESPONSE = json_response({"status": "error", "message": "Invalid or expired signature"}, 403)
+MISSING_PARAMS_RESPONSE = json_response({"status": "error", "message": "Missing required parameters"}, 400)
+INVALID_DEVICE_RESPONSE = json_response({"status": "error", "message": f"Invalid device_id, expected {config.DEVICE_ID}"}, 400)
+
 def load_public_key():
     global public_key
     if ECC is None:
@@ -37,7 +47,7 @@ def load_public_key():
         logger.info("Public key loaded successfully")
         return True
     except Exception as e:
-        logger.error(f"Failed to load public key: {e}")
+        logger.error("Failed to load public key: %s", e)
         return False
 
 def verify_signature(chat_id: str, timestamp: str, signature_b64: str):
@@ -46,14 +56,14 @@ def verify_signature(chat_id: str, timestamp: str, signature_b64: str):
         return False
 
     if not all([chat_id, timestamp, signature_b64]):
-        logger.error(f"Missing required parameters for signature verification: chat_id={chat_id}, timestamp={timestamp}, signature_b64={signature_b64}")
+        logger.error("Missing required parameters for signature verification: chat_id=%s, timestamp=%s, signature_b64=%s", chat_id, timestamp, signature_b64)
         return False
 
     try:
         timestamp_int = int(timestamp)
         current_time = int(time.time())
         if abs(current_time - timestamp_int) > 300:
-            logger.error(f"Timestamp expired: current={current_time}, received={timestamp_int}")
+            logger.error("Timestamp expired: current=%s, received=%s", current_time, timestamp_int)
             return False
 
         message = f"{chat_id}:{timestamp}".encode('utf-8')
@@ -61,22 +71,22 @@ def verify_signature(chat_id: str, timestamp: str, signature_b64: str):
         signature = base64.b64decode(signature_b64)
         verifier = DSS.new(public_key, 'fips-186-3')
         verifier.verify(h, signature)
-        logger.info(f"Signature verified for chat_id: {chat_id}")
+        logger.info("Signature verified for chat_id: %s", chat_id)
         return True
     except (ValueError, TypeError) as e:
-        logger.error(f"Signature verification failed: {e}, chat_id={chat_id}, timestamp={timestamp}, signature_b64={signature_b64}")
+        logger.error("Signature verification failed: %s, chat_id=%s, timestamp=%s, signature_b64=%s", e, chat_id, timestamp, signature_b64)
         return False
     except Exception as e:
-        logger.error(f"Unexpected error in signature verification: {e}")
+        logger.error("Unexpected error in signature verification: %s", e)
         return False
 
 def find_device(device_id: str):
-    for device in devices:
-        if device["device_id"] == device_id:
-            return device
+    device = devices.get(device_id)
+    if device is not None:
+        return device
     new_device = {"device_id": device_id, "state": "off"}
-    devices.append(new_device)
-    logger.info(f"Added new device: {device_id}")
+    devices[device_id] = new_device
+    logger.info("Added new device: %s", device_id)
     return new_device
 
 @app.route('/signature', methods=['POST'])
@@ -84,20 +94,20 @@ def signature():
     data = request.get_json()
     if not data:
         logger.error("Missing JSON data in /signature request")
-        return jsonify({"status": "error", "message": "Missing JSON data"}), 400
+        return MISSING_JSON_RESPONSE
 
     chat_id = data.get("chat_id")
     timestamp = data.get("timestamp")
     signature_b64 = data.get("signature")
 
     if not all([chat_id, timestamp, signature_b64]):
-        logger.error(f"Missing fields in /signature request: chat_id={chat_id}, timestamp={timestamp}, signature_b64={signature_b64}")
-        return jsonify({"status": "error", "message": "Missing fields"}), 400
+        logger.error("Missing fields in /signature request: chat_id=%s, timestamp=%s, signature_b64=%s", chat_id, timestamp, signature_b64)
+        return MISSING_FIELDS_RESPONSE
 
     if verify_signature(chat_id, timestamp, signature_b64):
-        return jsonify({"status": "success", "message": "Signature valid"}), 200
+        return SIGNATURE_VALID_RESPONSE
     else:
-        return jsonify({"status": "error", "message": "Invalid signature"}), 403
+        return INVALID_SIGNATURE_RESPONSE
 
 # New ESP32 API paths
 @app.route('/ESP32/<device_id>/Enable', methods=['GET', 'POST'])
@@ -117,15 +127,15 @@ def enable_esp32(device_id):
         bot_token = request.args.get('bot_token', "")
 
     if not all([device_id, chat_id, timestamp, signature_b64]):
-        logger.error(f"Missing required parameters in /ESP32/{device_id}/Enable request: device_id={device_id}, chat_id={chat_id}, timestamp={timestamp}, signature_b64={signature_b64}")
-        return jsonify({"status": "error", "message": "Missing required parameters"}), 400
+        logger.error("Missing required parameters in /ESP32/%s/Enable request: device_id=%s, chat_id=%s, timestamp=%s, signature_b64=%s", device_id, device_id, chat_id, timestamp, signature_b64)
+        return MISSING_PARAMS_RESPONSE
 
     if not verify_signature(chat_id, timestamp, signature_b64):
-        return jsonify({"status": "error", "message": "Invalid or expired signature"}), 403
+        return EXPIRED_SIGNATURE_RESPONSE
 
     if device_id != config.DEVICE_ID:
-        logger.error(f"Invalid device_id: {device_id}, expected {config.DEVICE_ID}")
-        return jsonify({"status": "error", "message": f"Invalid device_id, expected {config.DEVICE_ID}"}), 400
+        logger.error("Invalid device_id: %s, expected %s", device_id, config.DEVICE_ID)
+        return INVALID_DEVICE_RESPONSE
 
     device = find_device(device_id)
     device["state"] = "on"
@@ -155,15 +165,15 @@ def disable_esp32(device_id):
         bot_token = request.args.get('bot_token', "")
 
     if not all([device_id, chat_id, timestamp, signature_b64]):
-        logger.error(f"Missing required parameters in /ESP32/{device_id}/Disable request: device_id={device_id}, chat_id={chat_id}, timestamp={timestamp}, signature_b64={signature_b64}")
-        return jsonify({"status": "error", "message": "Missing required parameters"}), 400
+        logger.error("Missing required parameters in /ESP32/%s/Disable request: device_id=%s, chat_id=%s, timestamp=%s, signature_b64=%s", device_id, device_id, chat_id, timestamp, signature_b64)
+        return MISSING_PARAMS_RESPONSE
 
     if not verify_signature(chat_id, timestamp, signature_b64):
-        return jsonify({"status": "error", "message": "Invalid or expired signature"}), 403
+        return EXPIRED_SIGNATURE_RESPONSE
 
     if device_id != config.DEVICE_ID:
-        logger.error(f"Invalid device_id: {device_id}, expected {config.DEVICE_ID}")
-        return jsonify({"status": "error", "message": f"Invalid device_id, expected {config.DEVICE_ID}"}), 400
+        logger.error("Invalid device_id: %s, expected %s", device_id, config.DEVICE_ID)
+        return INVALID_DEVICE_RESPONSE
 
     device = find_device(device_id)
     device["state"] = "off"
@@ -193,15 +203,15 @@ def get_status_esp32(device_id):
         bot_token = request.args.get('bot_token', "")
 
     if not all([device_id, chat_id, timestamp, signature_b64]):
-        logger.error(f"Missing required parameters in /ESP32/{device_id}/GetStatus request: device_id={device_id}, chat_id={chat_id}, timestamp={timestamp}, signature_b64={signature_b64}")
-        return jsonify({"status": "error", "message": "Missing required parameters"}), 400
+        logger.error("Missing required parameters in /ESP32/%s/GetStatus request: device_id=%s, chat_id=%s, timestamp=%s, signature_b64=%s", device_id, device_id, chat_id, timestamp, signature_b64)
+        return MISSING_PARAMS_RESPONSE
 
     if not verify_signature(chat_id, timestamp, signature_b64):
-        return jsonify({"status": "error", "message": "Invalid or expired signature"}), 403
+        return EXPIRED_SIGNATURE_RESPONSE
 
     if device_id != config.DEVICE_ID:
-        logger.error(f"Invalid device_id: {device_id}, expected {config.DEVICE_ID}")
-        return jsonify({"status": "error", "message": f"Invalid device_id, expected {config.DEVICE_ID}"}), 400
+        logger.error("Invalid device_id: %s, expected %s", device_id, config.DEVICE_ID)
+        return INVALID_DEVICE_RESPONSE
 
     device = find_device(device_id)
 
@@ -226,12 +236,18 @@ def disable_legacy():
 def get_status_legacy():
     return get_status_esp32(config.DEVICE_ID)
 
+def init_service():
+    """Load the public key used to verify command signatures; run once per worker."""
+    load_public_key()
+
+# Development entry point; in production serve with
+#   GUNICORN_WORKERS=1 gunicorn -c gunicorn.conf.py -b 0.0.0.0:5010 esp32_virtual_device:app
 if __name__ == "__main__":
     try:
-        load_public_key()
-        logger.info(f"Starting Flask app on port 5010")
-        app.run(host="0.0.0.0", port=5010, debug=False)
+        init_service()
+        logger.info("Starting Flask app on port 5010")
+        app.run(host="0.0.0.0", port=5010, debug=False, threaded=True)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     except Exception as e:
-        logger.error(f"Fatal error: {e}")
\ No newline at end of file
+        logger.error("Fatal error: %s", e)
\ No newline at end of file
@@ -0,0 +1,79 @@
+# flask_common.py
+# Flask app setup, JSON responses and static files shared by the IM services and the device services
+import gzip
+import mimetypes
+import os
+import tempfile
+from flask import Flask, Response, request, send_from_directory
+
+try:
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    from json import dumps as json_dumps, loads as json_loads
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def create_app(import_name: str) -> Flask:
+    """Create a service's Flask app with the settings every service shares."""
+    app = Flask(import_name)
+    # Response dicts are small and consumers never rely on key order, so skip sorting them in jsonify
+    app.json.sort_keys = False
+    return app
+
+def json_response(body, status: int = 200) -> tuple:
+    """
+    Return a (body, status, headers) view result without going through jsonify.
+    body is a dict to encode or an already encoded JSON body; results for constant bodies are
+    built once at import and returned as-is from every request.
+    """
+    if not isinstance(body, (bytes, str)):
+        body = json_dumps(body)
+    return body, status, JSON_HEADERS
+
+def request_json() -> dict:
+    """Decode a POST body with the module's JSON loader (orjson when available); {} if it is not a JSON object."""
+    try:
+        data = json_loads(request.get_data())
+    except ValueError:
+        return {}
+    return data if isinstance(data, dict) else {}
+
+def relay_response(response) -> Response:
+    """Pass a device API response through to the caller."""
+    # Relay the device's JSON body as-is rather than decoding and re-encoding it
+    return Response(response.content, status=response.status_code,
+                    content_type=response.headers.get("Content-Type", "application/json"))
+
+def publish_openapi_spec(source: str = 'openapi.yaml', directory: str = 'static'):
+    """Copy the OpenAPI spec and a gzipped copy of it into directory.
+
+    Every worker calls this as it starts, so each file is written to a temporary name and
+    renamed into place; a request never sees a partly written spec.
+    """
+    os.makedirs(directory, exist_ok=True)
+    with open(source, 'rb') as f:
+        spec = f.read()
+    name = os.path.basename(source)
+    for target, data in ((name, spec), (name + '.gz', gzip.compress(spec, compresslevel=6))):
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix=f".{target}.")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, os.path.join(directory, target))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+def send_static(path: str, max_age: int, directory: str = 'static') -> Response:
+    """Serve a static file, using its precompressed .gz copy when the client accepts gzip."""
+    has_gzip = os.path.isfile(os.path.join(directory, path + '.gz'))
+    if has_gzip and 'gzip' in request.accept_encodings:
+        response = send_from_directory(directory, path + '.gz', max_age=max_age,
+                                       mimetype=mimetypes.guess_type(path)[0] or 'application/octet-stream')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = send_from_directory(directory, path, max_age=max_age)
+    if has_gzip:
+        # Either body can be served for this URL, so shared caches must key on Accept-Encoding
+        response.vary.add('Accept-Encoding')
+    return response
@@ -0,0 +1,24 @@
+# gunicorn.conf.py
+# Shared Gunicorn settings for the Flask microservices, e.g.
+#   gunicorn -c gunicorn.conf.py -b 0.0.0.0:5001 IMLine:app
+import os
+import sys
+
+# gevent workers turn the blocking requests/pika I/O into cooperative greenlets,
+# so one worker can keep many webhook and outbound HTTP calls in flight.
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+# Chat/greeting state is held in process memory unless REDIS_URL is set, so only scale out by
+# default when it is shared. Each worker runs its own queue consumer and RabbitMQ publisher thread,
+# so request handlers never share a pika channel.
+workers = int(os.getenv('GUNICORN_WORKERS', 4 if os.getenv('REDIS_URL') else 1))
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', 1000))
+# Only used with GUNICORN_WORKER_CLASS=gthread
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 30))
+
+def post_worker_init(worker):
+    """Run the served module's init_service() (queue consumers, static files) in each worker."""
+    module = sys.modules.get(getattr(worker.wsgi, 'import_name', ''))
+    init_service = getattr(module, 'init_service', None)
+    if init_service is not None:
+        init_service()
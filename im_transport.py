@@ -0,0 +1,127 @@
+# im_transport.py
+# Shared transport for forwarding messages between the IM services (IMTelegram / IMLine)
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import logging
+import config
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Shared HTTP session so repeated calls reuse keep-alive connections instead of a new TCP/TLS handshake each time
+http_session = requests.Session()
+_http_adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=128,
+    # Only connection failures are retried: every call through this session sends a message,
+    # and a retry after a read timeout or 5xx could deliver it twice
+    max_retries=Retry(connect=2, read=0, status=0, backoff_factor=0.2)
+)
+http_session.mount("https://", _http_adapter)
+http_session.mount("http://", _http_adapter)
+
+# Pool for send_many fan-out; callers block on the results, never on this pool from inside it
+send_pool = ThreadPoolExecutor(max_workers=32)
+
+# Service endpoints are fixed for the life of the process, so build them once
+TELEGRAM_SEND_URL = f"http://{config.TELEGRAM_API_HOST}:{config.TELEGRAM_API_PORT}/IMTelegram/SendMsg"
+TELEGRAM_BATCH_URL = f"http://{config.TELEGRAM_API_HOST}:{config.TELEGRAM_API_PORT}/IMTelegram/SendBatch"
+LINE_SEND_URL = f"http://{config.LINE_API_HOST}:{config.LINE_API_PORT}/IMLine/SendMsg"
+
+def forward(platform: str, url: str, params: dict, text: str) -> bool:
+    try:
+        logger.info("Sending message to %s API: %s", platform, url)
+        response = http_session.get(url, params=params, timeout=5)
+
+        if response.status_code == 200 and response.json().get("ok"):
+            logger.info("Message sent successfully to %s: %s", platform, text)
+            return True
+        else:
+            logger.error("Failed to send message to %s: %s", platform, response.text)
+            return False
+    except Exception as e:
+        logger.error("Error sending message to %s: %s", platform, e)
+        return False
+
+def send_telegram(chat_id: str, text: str, user_id: str = None, username: str = None) -> bool:
+    params = {
+        "chat_id": chat_id,
+        "message": text,
+        "user_id": user_id,
+        "bot_token": config.TELEGRAM_BOT_TOKEN
+    }
+    return forward("telegram", TELEGRAM_SEND_URL, params, text)
+
+def send_line(chat_id: str, text: str, user_id: str = None, username: str = None) -> bool:
+    params = {
+        "user_id": chat_id,
+        "message": text,
+        "caller_user_id": username,
+        "bot_token": config.LINE_ACCESS_TOKEN
+    }
+    return forward("line", LINE_SEND_URL, params, text)
+
+SENDERS = {
+    "telegram": send_telegram,
+    "line": send_line,
+}
+
+def send_message(chat_id: str, text: str, platform: str = "telegram", user_id: str = None, username: str = None) -> bool:
+    """Send message to the appropriate platform based on the platform parameter"""
+    sender = SENDERS.get(platform)
+    if sender is None:
+        logger.error("Unsupported platform: %s", platform)
+        return False
+    return sender(chat_id, text, user_id=user_id, username=username)
+
+def group_recipients_by_platform(recipients) -> dict:
+    """Collapse (chat_id, platform) pairs into {platform: {chat_id, ...}}, dropping duplicates."""
+    by_platform = defaultdict(set)
+    for chat_id, platform in recipients:
+        by_platform[platform].add(chat_id)
+    return by_platform
+
+def send_telegram_batch(chat_ids, message: str) -> bool:
+    """Forward one message for many Telegram chats to IMTelegram's /SendBatch in a single request."""
+    payload = {
+        "bot_token": config.TELEGRAM_BOT_TOKEN,
+        "items": [{"chat_id": chat_id, "message": message} for chat_id in chat_ids]
+    }
+    try:
+        response = http_session.post(TELEGRAM_BATCH_URL, json=payload, timeout=config.TELEGRAM_BATCH_TIMEOUT)
+        if response.status_code not in (200, 500):
+            # /SendBatch answers 500 with per-chat results when only some sends failed
+            logger.error("Telegram batch request failed: %s %s", response.status_code, response.text)
+            return False
+        result = response.json()
+        if not isinstance(result, dict):
+            logger.error("Unexpected Telegram batch response: %s", response.text)
+            return False
+        for item in result.get("results") or []:
+            if not isinstance(item, dict) or not item.get("ok"):
+                logger.warning("Failed to send message to chat_id=%s on Telegram",
+                               item.get('chat_id') if isinstance(item, dict) else None)
+        return response.status_code == 200 and bool(result.get("ok"))
+    except (requests.RequestException, ValueError) as e:
+        logger.error("Error sending batch of %s messages on Telegram: %s", len(chat_ids), e)
+        return False
+
+def send_many(chat_ids, text: str, platform: str = "telegram", user_id: str = None, username: str = None) -> bool:
+    """Send the same text to many chats on one platform in a single concurrent pass; True only if all succeed.
+
+    Telegram chats are grouped into /SendBatch requests of config.TELEGRAM_BATCH_SIZE, other
+    platforms get one request per chat, all issued concurrently on send_pool.
+    """
+    chat_ids = list(chat_ids)
+    if not chat_ids:
+        return True
+    if platform == "telegram":
+        futures = [send_pool.submit(send_telegram_batch, chat_ids[start:start + config.TELEGRAM_BATCH_SIZE], text)
+                   for start in range(0, len(chat_ids), config.TELEGRAM_BATCH_SIZE)]
+    else:
+        futures = [send_pool.submit(send_message, chat_id, text, platform, user_id=user_id, username=username)
+                   for chat_id in chat_ids]
+    return all([future.result() for future in futures])
@@ -1,4 +1,5 @@
-from flask import Flask, request, jsonify
+from flask import request, jsonify
+from flask_common import create_app, json_response
 import logging
 import time
 import base64
@@ -40,10 +41,18 @@ except (ImportError, RuntimeError):
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-app = Flask(__name__)
-devices = [{"device_id": "raspberrypi_light_001", "state": "off"}]
+app = create_app(__name__)
+# device_id -> device state
+devices = {"raspberrypi_light_001": {"device_id": "raspberrypi_light_001", "state": "off"}}
 public_key = None
 
+MISSING_JSON_RESPONSE = json_response({"status": "error", "message": "Missing JSON data"}, 400)
+MISSING_FIELDS_RESPONSE = json_response({"status": "error", "message": "Missing fields"}, 400)
+SIGNATURE_VALID_RESPONSE = json_response({"status": "success", "message": "Signature valid"}, 200)
+INVALID_SIGNATURE_RESPONSE = json_response({"status": "error", "message": "Invalid signature"}, 403)
+EXPIRED_SIGNATURE_RESPONSE = json_response({"status": "error", "message": "Invalid or expired signature"}, 403)
+INVALID_DEVICE_RESPONSE = json_response({"status": "error", "message": "Invalid device_id, expected raspberrypi_light_001"}, 400)
+
 def load_public_key():
     global public_key
     if ECC is None:
@@ -58,7 +67,7 @@ def load_public_key():
         logger.info("Public key loaded successfully")
         return True
     except Exception as e:
-        logger.error(f"Failed to load public key: {e}")
+        logger.error("Failed to load public key: %s", e)
         return False
 
 def verify_signature(chat_id: str, timestamp: str, signature_b64: str):
@@ -67,25 +76,25 @@ def verify_signature(chat_id: str, timestamp: str, signature_b64: str):
         logger.warning("Crypto libraries not available, skipping signature verification")
         return True        
     try:
-        logger.debug(f"Starting signature verification for chat_id: {chat_id}, timestamp: {timestamp}")
+        logger.debug("Starting signature verification for chat_id: %s, timestamp: %s", chat_id, timestamp)
         
         message = f"{chat_id}:{timestamp}"
-        logger.debug(f"Original message to verify: '{message}'")
+        logger.debug("Original message to verify: '%s'", message)
         
         message_bytes = message.encode('utf-8')
-        logger.debug(f"Message bytes: {message_bytes.hex()}")
+        logger.debug("Message bytes: %s", message_bytes.hex())
         
         h = SHA256.new(message_bytes)
-        logger.debug(f"SHA256 hash: {h.hexdigest()}")
+        logger.debug("SHA256 hash: %s", h.hexdigest())
         
-        logger.debug(f"Received base64 signature: {signature_b64}")
+        logger.debug("Received base64 signature: %s", signature_b64)
         try:
             signature = base64.b64decode(signature_b64)
-            logger.debug(f"Decoded signature (hex): {signature.hex()}")
-            logger.debug(f"Signature length: {len(signature)} bytes")
+            logger.debug("Decoded signature (hex): %s", signature.hex())
+            logger.debug("Signature length: %s bytes", len(signature))
         except Exception as e:
-            logger.error(f"Base64 decoding failed: {str(e)}")
-            logger.error(f"Problematic base64 string: {signature_b64}")
+            logger.error("Base64 decoding failed: %s", str(e))
+            logger.error("Problematic base64 string: %s", signature_b64)
             return False
         
         logger.debug("Creating DSS verifier...")
@@ -95,32 +104,32 @@ def verify_signature(chat_id: str, timestamp: str, signature_b64: str):
         try:
             verifier.verify(h, signature)
             logger.info("Signature verification SUCCESSFUL")
-            logger.debug(f"Verified message: '{message}'")
-            logger.debug(f"With signature: {signature.hex()}")
+            logger.debug("Verified message: '%s'", message)
+            logger.debug("With signature: %s", signature.hex())
             return True
         except ValueError as ve:
-            logger.error(f"Signature verification FAILED (ValueError): {str(ve)}")
-            logger.debug(f"Failed details - Hash: {h.hexdigest()}, Signature: {signature.hex()}")
+            logger.error("Signature verification FAILED (ValueError): %s", str(ve))
+            logger.debug("Failed details - Hash: %s, Signature: %s", h.hexdigest(), signature.hex())
             return False
         except TypeError as te:
-            logger.error(f"Signature verification FAILED (TypeError): {str(te)}")
+            logger.error("Signature verification FAILED (TypeError): %s", str(te))
             return False
             
     except base64.binascii.Error as be:
-        logger.error(f"Base64 decoding error: {str(be)}")
-        logger.error(f"Problematic base64 string: {signature_b64}")
+        logger.error("Base64 decoding error: %s", str(be))
+        logger.error("Problematic base64 string: %s", signature_b64)
         return False
     except Exception as e:
-        logger.error(f"Unexpected error during signature verification: {str(e)}", exc_info=True)
+        logger.error("Unexpected error during signature verification: %s", str(e), exc_info=True)
         return False
 
 def find_device(device_id: str):
-    for device in devices:
-        if device["device_id"] == device_id:
-            return device
+    device = devices.get(device_id)
+    if device is not None:
+        return device
     new_device = {"device_id": device_id, "state": "off"}
-    devices.append(new_device)
-    logger.info(f"Added new device: {device_id}")
+    devices[device_id] = new_device
+    logger.info("Added new device: %s", device_id)
     return new_device
 
 def turn_on_light():
@@ -144,14 +153,14 @@ def blink_light(times=3, interval=0.5):
         GPIO.output(RELAY_1, GPIO.HIGH)
         GPIO.output(RELAY_2, GPIO.HIGH)
         time.sleep(interval)
-    logger.info(f"Light blinked {times} times")
+    logger.info("Light blinked %s times", times)
 
 @app.route('/signature', methods=['POST'])
 def signature():
     data = request.get_json()
     if not data:
         logger.error("Missing JSON data")
-        return jsonify({"status": "error", "message": "Missing JSON data"}), 400
+        return MISSING_JSON_RESPONSE
     
     chat_id = data.get("chat_id")
     timestamp = data.get("timestamp")
@@ -159,12 +168,12 @@ def signature():
     
     if not chat_id or not timestamp or not signature_b64:
         logger.error("Missing fields in JSON")
-        return jsonify({"status": "error", "message": "Missing fields"}), 400
+        return MISSING_FIELDS_RESPONSE
     
     if verify_signature(chat_id, timestamp, signature_b64):
-        return jsonify({"status": "success", "message": "Signature valid"}), 200
+        return SIGNATURE_VALID_RESPONSE
     else:
-        return jsonify({"status": "error", "message": "Invalid signature"}), 403
+        return INVALID_SIGNATURE_RESPONSE
 
 # New Raspberry Pi API paths
 @app.route('/Pi/<device_id>/Enable', methods=['GET', 'POST'])
@@ -184,11 +193,11 @@ def enable_pi(device_id):
         bot_token = request.args.get('bot_token', "")
     
     if not verify_signature(chat_id, timestamp, signature_b64):
-        return jsonify({"status": "error", "message": "Invalid or expired signature"}), 403
+        return EXPIRED_SIGNATURE_RESPONSE
     
     if not device_id or device_id != "raspberrypi_light_001":
-        logger.error(f"Invalid device_id: {device_id}, expected raspberrypi_light_001")
-        return jsonify({"status": "error", "message": "Invalid device_id, expected raspberrypi_light_001"}), 400
+        logger.error("Invalid device_id: %s, expected raspberrypi_light_001", device_id)
+        return INVALID_DEVICE_RESPONSE
     
     device = find_device(device_id)
     device["state"] = "on"
@@ -219,11 +228,11 @@ def disable_pi(device_id):
         bot_token = request.args.get('bot_token', "")
     
     if not verify_signature(chat_id, timestamp, signature_b64):
-        return jsonify({"status": "error", "message": "Invalid or expired signature"}), 403
+        return EXPIRED_SIGNATURE_RESPONSE
     
     if not device_id or device_id != "raspberrypi_light_001":
-        logger.error(f"Invalid device_id: {device_id}, expected raspberrypi_light_001")
-        return jsonify({"status": "error", "message": "Invalid device_id, expected raspberrypi_light_001"}), 400
+        logger.error("Invalid device_id: %s, expected raspberrypi_light_001", device_id)
+        return INVALID_DEVICE_RESPONSE
     
     device = find_device(device_id)
     device["state"] = "off"
@@ -254,11 +263,11 @@ def get_status_pi(device_id):
         bot_token = request.args.get('bot_token', "")
     
     if not verify_signature(chat_id, timestamp, signature_b64):
-        return jsonify({"status": "error", "message": "Invalid or expired signature"}), 403
+        return EXPIRED_SIGNATURE_RESPONSE
     
     if not device_id or device_id != "raspberrypi_light_001":
-        logger.error(f"Invalid device_id: {device_id}, expected raspberrypi_light_001")
-        return jsonify({"status": "error", "message": "Invalid device_id, expected raspberrypi_light_001"}), 400
+        logger.error("Invalid device_id: %s, expected raspberrypi_light_001", device_id)
+        return INVALID_DEVICE_RESPONSE
     
     device = find_device(device_id)
     
@@ -289,16 +298,22 @@ def cleanup():
         GPIO.cleanup()
         logger.info("GPIO cleanup completed")
     except Exception as e:
-        logger.error(f"Error during GPIO cleanup: {e}")
+        logger.error("Error during GPIO cleanup: %s", e)
 
 atexit.register(cleanup)
 
+def init_service():
+    """Load the public key used to verify command signatures; run once per worker."""
+    load_public_key()
+
+# Development entry point; in production serve with
+#   GUNICORN_WORKERS=1 gunicorn -c gunicorn.conf.py -b 0.0.0.0:5011 raspberry_pi_virtual_device:app
 if __name__ == "__main__":
     try:
-        load_public_key()
+        init_service()
         logger.info("Starting Raspberry Pi Virtual Device on port 5011")
-        app.run(host="0.0.0.0", port=5011, debug=False)
+        app.run(host="0.0.0.0", port=5011, debug=False, threaded=True)
     except KeyboardInterrupt:
         logger.info("Shutting down...")
     except Exception as e:
-        logger.error(f"Fatal error: {e}")
\ No newline at end of file
+        logger.error("Fatal error: %s", e)
\ No newline at end of file
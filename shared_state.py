@@ -0,0 +1,72 @@
+# shared_state.py
+# Chat/user id sets that can be shared by several worker processes through Redis
+import logging
+from threading import Lock
+import config
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+redis_client = None
+if config.REDIS_URL:
+    if redis is None:
+        logger.warning("REDIS_URL is set but the redis package is not installed, using process-local state")
+    else:
+        redis_client = redis.Redis.from_url(config.REDIS_URL, decode_responses=True)
+        logger.info("Using Redis for shared chat state: %s", config.REDIS_URL)
+
+class IdSet:
+    """
+    Grow-only set of ids backed by a Redis SET when REDIS_URL is configured, otherwise by a local set.
+    Members are never removed, so a lock-free frozenset snapshot of ids this process has already
+    seen answers repeat lookups without a lock or a Redis round trip.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self._members = set()
+        self._snapshot = frozenset()
+        self._lock = Lock()
+
+    def _remember(self, member: str) -> bool:
+        with self._lock:
+            if member in self._members:
+                return False
+            self._members.add(member)
+            self._snapshot = frozenset(self._members)
+            return True
+
+    def add(self, member: str) -> bool:
+        """Add member; True only for the first add across every process sharing the set."""
+        if member in self._snapshot:
+            return False
+        if redis_client is not None:
+            try:
+                added = redis_client.sadd(self.name, member) == 1
+                self._remember(member)
+                return added
+            except Exception as e:
+                logger.error("Redis SADD %s failed, using process-local state: %s", self.name, e)
+        return self._remember(member)
+
+    def members(self) -> frozenset:
+        if redis_client is not None:
+            try:
+                return frozenset(redis_client.smembers(self.name))
+            except Exception as e:
+                logger.error("Redis SMEMBERS %s failed, using process-local state: %s", self.name, e)
+        return self._snapshot
+
+    def __contains__(self, member: str) -> bool:
+        if member in self._snapshot:
+            return True
+        if redis_client is not None:
+            try:
+                return bool(redis_client.sismember(self.name, member))
+            except Exception as e:
+                logger.error("Redis SISMEMBER %s failed, using process-local state: %s", self.name, e)
+        return False
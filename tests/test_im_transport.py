@@ -0,0 +1,26 @@
+# test_im_transport.py
+import config
+import im_transport
+from im_transport import send_many
+
+def test_send_many_chunks_telegram_chats(monkeypatch):
+    batches = []
+    monkeypatch.setattr(config, "TELEGRAM_BATCH_SIZE", 2)
+    monkeypatch.setattr(im_transport, "send_telegram_batch", lambda chat_ids, text: batches.append((chat_ids, text)) or True)
+    assert send_many(["1", "2", "3", "4", "5"], "hello")
+    assert sorted(batches) == [(["1", "2"], "hello"), (["3", "4"], "hello"), (["5"], "hello")]
+
+def test_send_many_fails_if_any_batch_fails(monkeypatch):
+    monkeypatch.setattr(config, "TELEGRAM_BATCH_SIZE", 2)
+    monkeypatch.setattr(im_transport, "send_telegram_batch", lambda chat_ids, text: "3" not in chat_ids)
+    assert not send_many(["1", "2", "3"], "hello")
+
+def test_send_many_sends_other_platforms_per_chat(monkeypatch):
+    sent = []
+    monkeypatch.setattr(im_transport, "send_message", lambda chat_id, text, platform, **kwargs: sent.append((chat_id, platform)) or True)
+    assert send_many(iter(["a", "b"]), "hello", platform="line")
+    assert sorted(sent) == [("a", "line"), ("b", "line")]
+
+def test_send_many_without_chats(monkeypatch):
+    monkeypatch.setattr(im_transport, "send_telegram_batch", lambda chat_ids, text: False)
+    assert send_many([], "hello")
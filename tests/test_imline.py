@@ -0,0 +1,63 @@
+# test_imline.py
+import queue
+import pytest
+import config
+import IMLine
+from IMLine import multicast_message
+
+class FakeResponse:
+    def __init__(self, status_code: int):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = ""
+
+@pytest.fixture
+def line(monkeypatch):
+    """Answer multicasts with the status in line.status and record per-user pushes."""
+    class Line:
+        status = 200
+        multicasts = []
+        pushes = []
+    monkeypatch.setattr(config, "LINE_ACCESS_TOKEN", "token")
+    monkeypatch.setattr(IMLine.http_session, "post", lambda url, **kwargs: Line.multicasts.append(kwargs["json"]["to"]) or FakeResponse(Line.status))
+    monkeypatch.setattr(IMLine, "push_message", lambda user_id, text: Line.pushes.append(user_id) or user_id != "bad")
+    return Line
+
+def test_multicast_sends_one_request(line):
+    assert multicast_message(["u1", "u2"], "hello")
+    assert line.multicasts == [["u1", "u2"]]
+    assert line.pushes == []
+
+def test_multicast_falls_back_to_pushes_on_4xx(line):
+    line.status = 400
+    assert multicast_message(["u1", "u2"], "hello")
+    assert line.pushes == ["u1", "u2"]
+
+def test_multicast_fallback_reports_failed_pushes(line):
+    line.status = 400
+    assert not multicast_message(["u1", "bad", "u2"], "hello")
+    assert line.pushes == ["u1", "bad", "u2"]
+
+@pytest.mark.parametrize("status", [429, 500])
+def test_multicast_does_not_fall_back_on_rate_limit_or_5xx(line, status):
+    line.status = status
+    assert not multicast_message(["u1", "u2"], "hello")
+    assert line.pushes == []
+
+def text_event(user_id: str, text: str) -> dict:
+    return {"type": "message", "message": {"type": "text", "text": text}, "source": {"type": "user", "userId": user_id}}
+
+def test_webhook_keeps_each_chat_on_one_worker_in_order(monkeypatch):
+    monkeypatch.setattr(IMLine, "webhook_queues", [queue.Queue(maxsize=10) for _ in range(IMLine.WEBHOOK_WORKER_COUNT)])
+    events = [text_event("u1", "/bind esp32_light_001"), text_event("u2", "hi"), text_event("u1", "turn on"), text_event("u1", "turn off")]
+    response = IMLine.app.test_client().post("/IMLine/webhook", json={"events": events})
+    assert response.status_code == 200
+    u1_queue = IMLine.webhook_queue_for("u1")
+    assert [event["message_text"] for event in u1_queue.queue if event["chat_id"] == "u1"] == ["/bind esp32_light_001", "turn on", "turn off"]
+    assert sum(work_queue.qsize() for work_queue in IMLine.webhook_queues) == 4
+
+def test_webhook_rejects_batch_that_does_not_fit(monkeypatch):
+    monkeypatch.setattr(IMLine, "webhook_queues", [queue.Queue(maxsize=1) for _ in range(IMLine.WEBHOOK_WORKER_COUNT)])
+    response = IMLine.app.test_client().post("/IMLine/webhook", json={"events": [text_event("u1", "turn on"), text_event("u1", "turn off")]})
+    assert response.status_code == 503
+    assert all(work_queue.empty() for work_queue in IMLine.webhook_queues)
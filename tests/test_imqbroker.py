@@ -0,0 +1,68 @@
+# test_imqbroker.py
+import pytest
+import config
+import IoTQbroker
+import IMQbroker
+from IMQbroker import BatchAcker
+
+class FakeChannel:
+    is_open = True
+
+    def __init__(self):
+        self.calls = []
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.calls.append(("ack", delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.calls.append(("nack", delivery_tag, requeue))
+
+@pytest.fixture
+def acker(monkeypatch):
+    monkeypatch.setattr(config, "RABBITMQ_ACK_BATCH_SIZE", 3)
+    acker = BatchAcker(None, FakeChannel())
+    for tag in (1, 2, 3, 4):
+        acker.track(tag)
+    return acker
+
+def test_acks_only_the_settled_head(acker):
+    acker.settle(2, True)
+    acker.flush()
+    assert acker.channel.calls == []
+    acker.settle(1, True)
+    acker.flush()
+    assert acker.channel.calls == [("ack", 2, True)]
+
+def test_nacks_failures_at_once_and_acks_around_them(acker):
+    acker.settle(2, False)
+    assert acker.channel.calls == [("nack", 2, False)]
+    acker.settle(1, True)
+    acker.settle(3, True)
+    acker.flush()
+    assert acker.channel.calls == [("nack", 2, False), ("ack", 3, True)]
+
+def test_acks_when_batch_fills(acker):
+    for tag in (3, 2, 1):
+        acker.settle(tag, True)
+    assert acker.channel.calls == [("ack", 3, True)]
+    acker.flush()
+    assert acker.channel.calls == [("ack", 3, True)]
+    acker.settle(4, True)
+    acker.flush()
+    assert acker.channel.calls == [("ack", 3, True), ("ack", 4, True)]
+
+def test_flush_skips_closed_channel(acker):
+    acker.settle(1, True)
+    acker.channel.is_open = False
+    acker.flush()
+    assert acker.channel.calls == []
+    assert acker.last_ok_tag is None
+
+def test_recipients_keep_group_members_on_their_platforms(monkeypatch):
+    monkeypatch.setattr(config, "load_bindings_shared", lambda: {"esp32_light_001": [{"chat_id": "t2", "platform": "telegram"}]})
+    monkeypatch.setattr(IoTQbroker, "device_groups", {})
+    monkeypatch.setattr(IMQbroker, "recipient_cache", {})
+    device = IoTQbroker.Device("LivingRoomLight", "esp32_light_001")
+    device.group.join("t1", "telegram")
+    device.group.join("U1", "line")
+    assert IMQbroker.get_device_recipients(device, "telegram") == {"telegram": {"t1", "t2"}, "line": {"U1"}}
@@ -0,0 +1,78 @@
+# test_iotqbroker.py
+import pytest
+import config
+import IoTQbroker
+from IoTQbroker import split_command, MessageAPI
+
+@pytest.mark.parametrize("text, expected", [
+    ("turn on esp32_light_001", ("enable", "esp32_light_001")),
+    ("/enable esp32_light_001", ("enable", "esp32_light_001")),
+    ("turn off\tlight_2", ("disable", "light_2")),
+    ("get status   fan_1", ("status", "fan_1")),
+    ("/bind ___", ("bind", "___")),
+    ("turn on", ("enable", None)),
+    ("/bind", (None, None)),
+    ("turn  on light_1", (None, None)),
+    ("turn on light-1", (None, None)),
+    ("switch on light_1", (None, None)),
+    ("", (None, None)),
+])
+def test_split_command(text, expected):
+    assert split_command(text) == expected
+
+@pytest.fixture
+def published(monkeypatch):
+    sent = []
+    monkeypatch.setattr(IoTQbroker.publisher, "publish", lambda queue_name, body: sent.append((queue_name, body)) or True)
+    return sent
+
+def test_send_encoded_drops_duplicates_within_window(monkeypatch, published):
+    monkeypatch.setattr(config, "COMMAND_DEDUP_WINDOW", 60)
+    api = MessageAPI("localhost", 5672)
+    assert api.send_encoded("esp32_cmd", b'{"command":"on"}')
+    assert api.send_encoded("esp32_cmd", b'{"command":"on"}')
+    assert api.send_encoded("esp32_cmd", b'{"command":"off"}')
+    assert api.send_encoded("pi_cmd", b'{"command":"on"}')
+    assert published == [("esp32_cmd", b'{"command":"on"}'), ("esp32_cmd", b'{"command":"off"}'),
+                         ("pi_cmd", b'{"command":"on"}')]
+
+def test_send_encoded_publishes_alternating_commands(monkeypatch, published):
+    monkeypatch.setattr(config, "COMMAND_DEDUP_WINDOW", 60)
+    api = MessageAPI("localhost", 5672)
+    for body in (b'{"command":"on"}', b'{"command":"off"}', b'{"command":"on"}'):
+        assert api.send_encoded("esp32_cmd", body, "chat_1")
+    assert [body for queue_name, body in published] == [b'{"command":"on"}', b'{"command":"off"}', b'{"command":"on"}']
+
+def test_send_encoded_keeps_chats_apart(monkeypatch, published):
+    monkeypatch.setattr(config, "COMMAND_DEDUP_WINDOW", 60)
+    api = MessageAPI("localhost", 5672)
+    assert api.send_encoded("esp32_cmd", b'{"command":"on"}', "chat_1")
+    assert api.send_encoded("esp32_cmd", b'{"command":"on"}', "chat_2")
+    assert api.send_encoded("esp32_cmd", b'{"command":"on"}', "chat_1")
+    assert len(published) == 2
+
+def test_send_encoded_without_window_publishes_every_command(monkeypatch, published):
+    monkeypatch.setattr(config, "COMMAND_DEDUP_WINDOW", 0)
+    api = MessageAPI("localhost", 5672)
+    assert api.send_encoded("esp32_cmd", b'{"command":"on"}')
+    assert api.send_encoded("esp32_cmd", b'{"command":"on"}')
+    assert len(published) == 2
+
+def test_send_encoded_reports_full_buffer(monkeypatch):
+    monkeypatch.setattr(config, "COMMAND_DEDUP_WINDOW", 0)
+    monkeypatch.setattr(IoTQbroker.publisher, "publish", lambda queue_name, body: False)
+    assert not MessageAPI("localhost", 5672).send_encoded("esp32_cmd", b'{}')
+
+def test_join_notice_reaches_each_member_on_its_platform(monkeypatch):
+    notices = []
+    monkeypatch.setattr(config, "save_binding", lambda device_id, chat_id, platform: True)
+    monkeypatch.setattr(IoTQbroker, "send_many", lambda chat_ids, text, platform: notices.append((sorted(chat_ids), platform)) or True)
+    monkeypatch.setattr(IoTQbroker, "device_groups", {})
+    device = IoTQbroker.Device("LivingRoomLight", "esp32_light_001")
+    assert device.bind_user("t1", "telegram")
+    assert notices == []
+    assert device.bind_user("U1", "line")
+    assert notices == [(["t1"], "telegram")]
+    assert device.bind_user("t2", "telegram")
+    assert sorted(notices[1:]) == [(["U1"], "line"), (["t1"], "telegram")]
+    assert device.group_members == {("t1", "telegram"), ("U1", "line"), ("t2", "telegram")}